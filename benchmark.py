@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+# End to end benchmark of the observer against local stand-ins for the homeserver and the bridges.
+# The stand-ins and the load generator run in a separate process, so they neither compete with
+# the observer for its event loop nor count towards its memory.
+#
+#   python benchmark.py --rooms 1000 --bridges 4 --users 50 --pushes 20000 --output bench_output.txt
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import sys
+import time
+import tracemalloc
+from aiohttp import ClientSession, web
+
+BRIDGE_STATE_PATH = "/_matrix/app/com.beeper.bridge_state"
+NOTIFY_ROOM = "!notify:bench"
+# States used while measuring throughput, latency samples use others so each of them is a change
+THROUGHPUT_STATES = ["CONNECTED", "TRANSIENT_DISCONNECT"]
+LATENCY_STATES = ["BAD_CREDENTIALS", "UNKNOWN_ERROR"]
+
+def bridge_name(b):
+    return f"bench{b}"
+
+def user_label(u):
+    return f"user{u}"
+
+def bridge_user_id(b, u):
+    return f"@{bridge_name(b)}_{u}:bench"
+
+def status(b, u, state):
+    return {
+        "user_id": bridge_user_id(b, u),
+        "remote_id": f"remote{u}",
+        "remote_name": f"Remote {u}",
+        "state_event": state,
+        "ttl": 3600,
+        "timestamp": int(time.time()),
+    }
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+# Serves the client-server API for the watched users and the notifier, the bridge_state
+# endpoints of all bridges, and /_bench endpoints to drive the load from the observer process
+class FakeServers:
+    def __init__(self, args):
+        self.args = args
+        self.bridge_users = [(b, u) for b in range(args.bridges) for u in range(args.users)]
+        # (expected text in a notification, future resolved with its arrival time)
+        self.waiters = []
+        self.sends = 0
+        self.last_send = time.monotonic()
+
+    def app(self):
+        app = web.Application(client_max_size=64*1024*1024)
+        app.router.add_post("/_matrix/client/v3/user/{user}/filter", self.upload_filter)
+        app.router.add_get("/_matrix/client/v3/sync", self.sync)
+        app.router.add_get("/_matrix/client/v3/rooms/{room}/messages", self.messages)
+        app.router.add_get("/_matrix/client/v3/rooms/{room}/state", self.room_state)
+        app.router.add_post("/_matrix/client/v3/rooms/{room}/read_markers", self.empty)
+        app.router.add_put("/_matrix/client/v3/rooms/{room}/send/{type}/{txn}", self.send)
+        app.router.add_get("/_matrix/client/v3/account/whoami", self.whoami)
+        app.router.add_post("/{bridge}" + BRIDGE_STATE_PATH, self.bridge_state)
+        app.router.add_post("/_bench/throughput", self.throughput)
+        app.router.add_post("/_bench/latency", self.latency)
+        return app
+
+    def message(self, event_id, ts, sender):
+        return {
+            "type": "m.room.message",
+            "sender": sender,
+            "event_id": event_id,
+            "origin_server_ts": ts,
+            "content": {"msgtype": "m.text", "body": "bench"},
+        }
+
+    def room(self, i, user_id):
+        now = int(time.time() * 1000)
+        bridge = bridge_name(i % self.args.bridges)
+        state = [{
+            "type": "m.bridge",
+            "state_key": bridge,
+            "sender": "@bot:bench",
+            "event_id": f"$bridge{i}",
+            "origin_server_ts": 1,
+            "content": {"protocol": {"id": bridge}},
+        }]
+        # Without backfill, the newest timeline event is a bridged message
+        sender = user_id if self.args.backfill_pages > 0 else "@bot:bench"
+        events = [self.message(f"$r{i}e{e}", now - 1000*(self.args.events - e), sender if e == self.args.events - 1 else user_id)
+                for e in range(self.args.events)]
+        return {
+            "state": {"events": state},
+            "timeline": {"events": events, "limited": True, "prev_batch": f"r{i}_0"},
+            "unread_notifications": {"notification_count": 0, "highlight_count": 0},
+        }
+
+    def requesting_user(self, request):
+        # Watched users use their user id as access token
+        return request.headers["Authorization"][len("Bearer "):]
+
+    async def upload_filter(self, request):
+        return web.json_response({"filter_id": "bench"})
+
+    async def sync(self, request):
+        user_id = self.requesting_user(request)
+        if "since" in request.query:
+            # Nothing new, hold the long poll like a homeserver would
+            await asyncio.sleep(min(int(request.query.get("timeout", 0)) / 1000, 30))
+            return web.json_response({"next_batch": request.query["since"], "rooms": {}})
+        join = {f"!room{i}:bench": self.room(i, user_id) for i in range(self.args.rooms)}
+        return web.json_response({"next_batch": "bench", "rooms": {"join": join}})
+
+    async def messages(self, request):
+        room_token, page = request.query["from"].split("_")
+        page = int(page)
+        now = int(time.time() * 1000)
+        sender = "@bot:bench" if page >= self.args.backfill_pages - 1 else self.requesting_user(request)
+        chunk = [self.message(f"${room_token}p{page}", now - 60_000*(page + 1), sender)]
+        return web.json_response({"chunk": chunk, "start": request.query["from"], "end": f"{room_token}_{page + 1}"})
+
+    async def room_state(self, request):
+        return web.json_response([])
+
+    async def empty(self, request):
+        return web.json_response({})
+
+    async def whoami(self, request):
+        return web.json_response({"user_id": "@notify:bench"})
+
+    async def send(self, request):
+        now = time.monotonic()
+        body = (await request.json())["body"]
+        self.sends += 1
+        self.last_send = now
+        for waiter in list(self.waiters):
+            expected, future = waiter
+            if expected in body and not future.done():
+                future.set_result(now)
+                self.waiters.remove(waiter)
+        return web.json_response({"event_id": f"$send{self.sends}"})
+
+    async def bridge_state(self, request):
+        user_id = request.query["user_id"]
+        b = int(request.match_info["bridge"][len("bench"):])
+        u = int(user_id.split("_")[1].split(":")[0])
+        return web.json_response({"remoteState": {f"remote{u}": status(b, u, "CONNECTED")}})
+
+    async def post_statuses(self, session, payloads):
+        body = "\n".join(json.dumps(payload) for payload in payloads)
+        async with session.post(self.args.listener_url, data=body) as response:
+            await response.read()
+            return response.status == 200
+
+    async def queue_stats(self, session):
+        async with session.get(self.args.listener_url + "queue") as response:
+            return await response.json()
+
+    async def throughput(self, request):
+        pushes = self.args.pushes
+        payloads = []
+        for n in range(pushes):
+            b, u = self.bridge_users[n % len(self.bridge_users)]
+            payloads.append(status(b, u, THROUGHPUT_STATES[(n // len(self.bridge_users)) % 2]))
+        batches = iter([payloads[i:i + self.args.batch] for i in range(0, pushes, self.args.batch)])
+        rejected = 0
+        async with ClientSession() as session:
+            before = await self.queue_stats(session)
+            start = time.monotonic()
+            async def worker():
+                nonlocal rejected
+                for batch in batches:
+                    if not await self.post_statuses(session, batch):
+                        rejected += 1
+            await asyncio.gather(*[worker() for _ in range(self.args.concurrency)])
+            posted = time.monotonic() - start
+            # Ingested once the listener has taken every push off its queue
+            while True:
+                stats = await self.queue_stats(session)
+                handled = stats["processed"] + stats["merged"] + stats["dropped"]
+                if stats["depth"] == 0 and handled - (before["processed"] + before["merged"] + before["dropped"]) >= pushes:
+                    break
+                await asyncio.sleep(0.01)
+            elapsed = time.monotonic() - start
+        # Let the notifications caused by the pushes go out before anything else is measured
+        while time.monotonic() - self.last_send < 1:
+            await asyncio.sleep(0.1)
+        return web.json_response({
+            "pushes": pushes,
+            "batch": self.args.batch,
+            "concurrency": self.args.concurrency,
+            "post_seconds": round(posted, 3),
+            "ingest_seconds": round(elapsed, 3),
+            "pushes_per_second": round(pushes / elapsed, 1),
+            "rejected_requests": rejected,
+            "merged": stats["merged"] - before["merged"],
+            "dropped": stats["dropped"] - before["dropped"],
+            "max_queue_lag_ms": round(stats["max_lag"] * 1000, 2),
+        })
+
+    async def latency(self, request):
+        latencies = []
+        timeouts = 0
+        async with ClientSession() as session:
+            for n in range(self.args.latency_samples):
+                b, u = self.bridge_users[n % len(self.bridge_users)]
+                state = LATENCY_STATES[(n // len(self.bridge_users)) % 2]
+                future = asyncio.get_running_loop().create_future()
+                self.waiters.append((f"[{state}] {bridge_name(b)} {user_label(u)}", future))
+                start = time.monotonic()
+                await self.post_statuses(session, [status(b, u, state)])
+                try:
+                    latencies.append(await asyncio.wait_for(future, 10) - start)
+                except asyncio.TimeoutError:
+                    timeouts += 1
+        result = {"samples": len(latencies), "timeouts": timeouts}
+        if len(latencies) > 0:
+            result.update({
+                "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+                "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+                "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+                "max_ms": round(max(latencies) * 1000, 2),
+            })
+        return web.json_response(result)
+
+async def serve_fakes(args, ready):
+    runner = web.AppRunner(FakeServers(args).app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+    ready.set()
+    await asyncio.Event().wait()
+
+def run_fakes(args, ready):
+    asyncio.run(serve_fakes(args, ready))
+
+def make_config(args):
+    hs_url = f"http://127.0.0.1:{args.port}"
+    watched_bridge_ids = {bridge_name(b): {"alert_after_inactivity": 3600, "alert_period": 3600} for b in range(args.bridges)}
+    bridges = dict()
+    for b in range(args.bridges):
+        bridges[bridge_name(b)] = {
+            "bridge_url": f"{hs_url}/{bridge_name(b)}",
+            "hs_token": "bench",
+            "max_ttl": 3600,
+            "ttl_if_unreachable": 60,
+            "alert_delay": 0,
+            "alert_period": 3600,
+            "users": {user_label(u): {"user_id": bridge_user_id(b, u), "remote_id": f"remote{u}"} for u in range(args.users)},
+        }
+    return {
+        "notify": {
+            "matrix": {"homeserver": hs_url, "mx_id": "@notify:bench", "token": "bench", "room_id": NOTIFY_ROOM},
+        },
+        "watched_users": {
+            f"@watch{w}:bench": {
+                "homeserver": hs_url,
+                "mx_id": f"@watch{w}:bench",
+                "token": f"@watch{w}:bench",
+                "watched_bridge_ids": watched_bridge_ids,
+                "raw_sync": args.raw_sync,
+            } for w in range(args.watched_users)
+        },
+        "bridge_status": {
+            "listen_endpoint": {"host": "127.0.0.1", "port": args.listener_port, "queue_size": args.queue_size},
+            "bridges": bridges,
+        },
+    }
+
+def peak_rss_mb():
+    # The observer resets the kernel's peak around each sync, util keeps the overall one
+    from util import process_peak_rss
+    return round(process_peak_rss() / 1024 / 1024, 1)
+
+async def wait_until(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise Exception("Timed out waiting for the observer")
+        await asyncio.sleep(0.005)
+
+async def run_observer(args):
+    # Imported here, so the fakes process does not carry the observer's modules
+    from bridge_info import BridgesWatcher
+    from dispatch import CallbackDispatcher
+    from mx_notify import MatrixNotify
+    from status_listener import status_listen
+    from user_watch import UserWatcher
+
+    config = make_config(args)
+    results = {"parameters": vars(args)}
+    notify = MatrixNotify(config)
+    dispatcher = CallbackDispatcher(config)
+
+    start = time.monotonic()
+    userWatcher = UserWatcher(config, dispatcher.wrap([notify]))
+    await wait_until(lambda: all(user.sync_next_batch_token != None for user in userWatcher.users), args.timeout)
+    elapsed = time.monotonic() - start
+    synced_rooms = args.rooms * args.watched_users
+    results["sync"] = {
+        "rooms": synced_rooms,
+        "seconds": round(elapsed, 3),
+        "seconds_per_1k_rooms": round(elapsed / synced_rooms * 1000, 3) if synced_rooms > 0 else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "sync_peak_rss_mb": round(max(user.last_sync_peak_rss or 0 for user in userWatcher.users) / 1024 / 1024, 1) if args.raw_sync else None,
+    }
+
+    # Everything kept per bridge user: watcher, scheduler and routing entries
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    bridgesWatcher = BridgesWatcher(config, dispatcher.wrap([notify]))
+    watchers = len(bridgesWatcher.bridge_watchers)
+    results["memory"] = {
+        "bridge_watchers": watchers,
+        "bytes_per_bridge_watcher": round((tracemalloc.get_traced_memory()[0] - before) / watchers) if watchers > 0 else None,
+    }
+    tracemalloc.stop()
+    runner = await status_listen([bridgesWatcher], config)
+    await wait_until(lambda: all(watcher.state != None for watcher in bridgesWatcher.bridge_watchers.values()), args.timeout)
+
+    async with ClientSession() as session:
+        for phase in ["throughput", "latency"]:
+            async with session.post(f"http://127.0.0.1:{args.port}/_bench/{phase}") as response:
+                results[phase] = await response.json()
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    for user in userWatcher.users:
+        await user.shutdown()
+    bridgesWatcher.scheduler.stop()
+    for bridge in bridgesWatcher.bridge_configs.values():
+        if bridge.poller != None:
+            await bridge.poller.close()
+    await notify._close_client()
+    await runner.cleanup()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the observer against local stand-ins for homeserver and bridges")
+    parser.add_argument("--rooms", type=int, default=1000, help="joined rooms per watched user")
+    parser.add_argument("--events", type=int, default=10, help="timeline events per room in the initial sync")
+    parser.add_argument("--backfill-pages", type=int, default=0, help="backfill pages until a bridged message is found, 0 to have one in the timeline")
+    parser.add_argument("--watched-users", type=int, default=1)
+    parser.add_argument("--raw-sync", action="store_true", help="parse syncs without nio's room bookkeeping")
+    parser.add_argument("--bridges", type=int, default=4)
+    parser.add_argument("--users", type=int, default=25, help="watched users per bridge")
+    parser.add_argument("--pushes", type=int, default=10000, help="status pushes sent to the listener")
+    parser.add_argument("--batch", type=int, default=1, help="statuses per push request")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent push requests")
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--latency-samples", type=int, default=200)
+    parser.add_argument("--port", type=int, default=29680, help="port of the homeserver and bridge stand-ins")
+    parser.add_argument("--listener-port", type=int, default=29681)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+    args.listener_url = f"http://127.0.0.1:{args.listener_port}/"
+
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setLevel(logging.WARNING)
+    logging.getLogger("").addHandler(handler)
+
+    ready = multiprocessing.Event()
+    fakes = multiprocessing.Process(target=run_fakes, args=(args, ready), daemon=True)
+    fakes.start()
+    try:
+        if not ready.wait(30):
+            raise Exception("Stand-in servers did not start")
+        results = asyncio.run(run_observer(args))
+    finally:
+        fakes.terminate()
+    del results["parameters"]["listener_url"]
+    output = json.dumps(results, indent=2)
+    if args.output != None:
+        with open(args.output, "w") as fout:
+            fout.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
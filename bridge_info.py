@@ -1,24 +1,157 @@
 #!/usr/bin/env python3
 
-from datetime import datetime, timedelta
-import json
+import asyncio
+from aiohttp import ClientResponseError, ClientSession, ClientTimeout, TCPConnector
 import logging
-from urllib import request, parse
+import time
 
+import metrics
+from state_store import from_timestamp
 from status_listener import StatusPostCallback
-from util import Looper
+from sharding import bridge_user_key
+from util import BREAKER_FAILURES, BREAKER_MAX_SECONDS, CircuitBreaker, CircuitOpenError, DeadlineScheduler, background_task
 
 GOOD_STATES = ["CONNECTED", "BACKFILLING"]
 OK_STATES = ["TRANSIENT_DISCONNECT", "CONNECTING"] + GOOD_STATES
 
+# Defaults for bridge_state polling
+POLL_POOL_SIZE = 8
+POLL_CONNECT_TIMEOUT = 5
+POLL_READ_TIMEOUT = 10
+
 class BridgeStatusUpdateCallback:
     def bridge_update(self, bridge, user_label, user_id, state, previous_state, is_good, is_bad, bad_since, alert):
         pass
 
-class BridgeWatcher(Looper, StatusPostCallback):
-    def __init__(self, bridge_id, config, user_label, user_id, remote_id, bridgeWatcher):
-        super().__init__(f"BridgeWatcher_{bridge_id}_{user_label}")
+# Polls the bridge_state endpoint of one bridge for all of its watchers, over one keep-alive connection pool
+class BridgeStatusPoller:
+    def __init__(self, bridge_id, config):
+        self.log = logging.getLogger(f"BridgeStatusPoller_{bridge_id}")
+        self.bridge_id = bridge_id
+        self.bridge_url = config["bridge_url"] + "/_matrix/app/com.beeper.bridge_state"
+        self.hs_token = config["hs_token"]
+        self.pool_size = config.get("poll_pool_size", POLL_POOL_SIZE)
+        self.timeout = ClientTimeout(
+                connect=config.get("poll_connect_timeout", POLL_CONNECT_TIMEOUT),
+                sock_read=config.get("poll_read_timeout", POLL_READ_TIMEOUT))
+        self.session = None
+        # user_id -> watchers, a response for one user covers all of them
+        self.watchers = dict()
+        # user_id -> (request task, watchers waiting for it)
+        self.in_flight = dict()
+        # While the bridge is down, checks fail without a request, apart from occasional probes
+        self.breaker = CircuitBreaker(f"bridge {bridge_id}",
+                config.get("breaker_failures", BREAKER_FAILURES),
+                config["ttl_if_unreachable"],
+                config.get("breaker_max_delay", BREAKER_MAX_SECONDS))
+
+    def register(self, watcher):
+        self.watchers.setdefault(watcher.user_id, []).append(watcher)
+
+    def unregister(self, watcher):
+        watchers = self.watchers.get(watcher.user_id, [])
+        if watcher in watchers:
+            watchers.remove(watcher)
+
+    async def fetch(self, watcher):
+        user_id = watcher.user_id
+        if user_id not in self.in_flight:
+            self.breaker.check()
+            waiting = set()
+            task = asyncio.get_running_loop().create_task(self._request(user_id, waiting))
+            self.in_flight[user_id] = (task, waiting)
+            task.add_done_callback(lambda task: self.in_flight.pop(user_id, None))
+        else:
+            self.log.debug(f"Joining pending request for {user_id}")
+        task, waiting = self.in_flight[user_id]
+        waiting.add(watcher)
+        return await asyncio.shield(task)
+
+    async def _request(self, user_id, waiting):
+        if self.session == None:
+            self.session = ClientSession(
+                timeout=self.timeout,
+                connector=TCPConnector(limit=self.pool_size),
+            )
+        headers = {
+            "Authorization": f"Bearer {self.hs_token}"
+        }
+        try:
+            with metrics.FETCH_STATUS_DURATION.time(bridge = self.bridge_id):
+                async with self.session.post(self.bridge_url, params={"user_id": user_id}, headers=headers) as response:
+                    response.raise_for_status()
+                    parsed = await response.json(content_type=None)
+        except ClientResponseError as e:
+            # The bridge answered, only errors on its side count against it
+            if e.status >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        except asyncio.CancelledError:
+            self.breaker.abandon()
+            raise
+        except:
+            self.breaker.failure()
+            raise
+        if self.breaker.success():
+            # Recheck the other users instead of waiting for their next check
+            for other_user_id, watchers in self.watchers.items():
+                if other_user_id != user_id:
+                    for other in watchers:
+                        other.update_now(self)
+        remote_state = parsed["remoteState"]
+        # Save the other watchers of this user their own request
+        for watcher in self.watchers.get(user_id, []):
+            if watcher not in waiting:
+                watcher.offer_remote_state(remote_state)
+        return parsed
+
+    async def close(self):
+        if self.session != None:
+            await self.session.close()
+            self.session = None
+
+# Interned bridge state, classified once instead of on every check
+class BridgeState:
+    __slots__ = ("name", "is_good", "is_ok")
+    def __init__(self, name):
+        self.name = name
+        self.is_good = name in GOOD_STATES
+        self.is_ok = name in OK_STATES
+
+BRIDGE_STATES = dict()
+
+def get_bridge_state(name):
+    if name == None:
+        return None
+    state = BRIDGE_STATES.get(name)
+    if state == None:
+        state = BRIDGE_STATES[name] = BridgeState(name)
+    return state
+
+# Settings shared by all watchers of one bridge
+class BridgeConfig:
+    def __init__(self, bridge_id, config):
         self.bridge_id = bridge_id
+        self.log = logging.getLogger(f"BridgeWatcher_{bridge_id}")
+        if "bridge_url" in config:
+            self.poller = BridgeStatusPoller(bridge_id, config)
+        else:
+            self.poller = None
+            self.log.warning("bridge_url not set - bridge crashes will not be detected")
+        self.max_ttl = config["max_ttl"]
+        self.ttl_if_unreachable = config["ttl_if_unreachable"]
+        # Seconds
+        self.alert_delay = config["alert_delay"]
+        self.alert_period = config["alert_period"]
+
+# One per bridge user, so kept small: slots only, settings shared per bridge, timestamps as epoch seconds
+class BridgeWatcher(StatusPostCallback):
+    __slots__ = ("bridge", "bridgeWatcher", "identifiable", "user_id", "user_label", "remote_id", "remote_name",
+            "state", "reported_state", "pending_data", "bad_since", "last_alert", "route")
+    def __init__(self, bridge, user_label, user_id, remote_id, bridgeWatcher):
+        self.bridge = bridge
         self.bridgeWatcher = bridgeWatcher
         # Whether we can identify incoming status_endpoint data as (ir-)relevant.
         # We can only do this once we did a status request and populated more data.
@@ -27,27 +160,76 @@ class BridgeWatcher(Looper, StatusPostCallback):
         self.user_label = user_label
         self.remote_id = remote_id
         self.remote_name = None
+        # BridgeState
         self.state = None
         self.reported_state = None
-        if "bridge_url" in config:
-            self.bridge_url = config["bridge_url"] + "/_matrix/app/com.beeper.bridge_state"
-        else:
-            self.log.warning("bridge_url not set - bridge crashes will not be detected")
-            self.bridge_url = None
-        self.hs_token = config["hs_token"]
-        self.max_ttl = config["max_ttl"]
-        self.ttl_if_unreachable = config["ttl_if_unreachable"]
-        self.alert_delay = timedelta(seconds=config["alert_delay"])
-        self.alert_period = timedelta(seconds=config["alert_period"])
+        if self.poller != None:
+            self.poller.register(self)
         self.pending_data = None
-        self.bad_since = datetime.now()
+        self.bad_since = time.time()
         self.last_alert = None
-        self.start_loop(self.update_loop)
-    def accepts_data(self, data):
+        # Key under which this watcher is routed at the moment
+        self.route = None
+        if bridgeWatcher.state_store != None:
+            data = bridgeWatcher.state_store.load("bridge_watcher", self.bridge_id, user_label)
+            if data != None:
+                self.restore(data)
+        bridgeWatcher.scheduler.add(self)
+    @property
+    def bridge_id(self):
+        return self.bridge.bridge_id
+    @property
+    def log(self):
+        return self.bridge.log
+    @property
+    def poller(self):
+        return self.bridge.poller
+    def update_now(self, updated_by):
+        self.bridgeWatcher.scheduler.update_now(self)
+    def stop(self):
+        self.bridgeWatcher.scheduler.remove(self)
+        if self.poller != None:
+            self.poller.unregister(self)
+    def dump(self):
+        return {
+            "user_id": self.user_id,
+            "remote_id": self.remote_id,
+            "remote_name": self.remote_name,
+            "state": self.state.name if self.state != None else None,
+            "reported_state": self.reported_state.name if self.reported_state != None else None,
+            "bad_since": self.bad_since,
+            "last_alert": self.last_alert,
+        }
+    def restore(self, data):
+        if data.get("user_id") != self.user_id:
+            # Stored for a different user under this label, nothing of it applies
+            self.log.info(f"{self.user_label}: Ignoring stored state of {data.get('user_id')}")
+            return
+        if self.remote_id == None and data["remote_id"] != None:
+            # We learned this one in a previous run
+            self.remote_id = data["remote_id"]
+            self.identifiable = True
+        self.remote_name = data["remote_name"]
+        self.state = get_bridge_state(data["state"])
+        self.reported_state = get_bridge_state(data["reported_state"])
+        self.bad_since = data["bad_since"]
+        self.last_alert = data["last_alert"]
+    def checkpoint(self):
+        if self.bridgeWatcher.state_store != None:
+            self.bridgeWatcher.state_store.save("bridge_watcher", self.bridge_id, self.user_label, self.dump())
+    def route_key(self):
+        # Key under which pushed statuses for this watcher are routed, once we can identify them
+        if not self.identifiable or self.remote_id == None:
+            return None
+        return (self.user_id, self.remote_id)
+    def set_identifiable(self):
+        if not self.identifiable:
+            self.identifiable = True
+            self.bridgeWatcher.update_route(self)
+    def accepts_data(self, parsed):
         if not self.identifiable:
             return False
         try:
-            parsed = json.loads(data)
             # Check if data relevant
             if (self.user_id == parsed["user_id"] and
                     self.remote_id != None and self.remote_id == parsed["remote_id"]):
@@ -55,11 +237,20 @@ class BridgeWatcher(Looper, StatusPostCallback):
                 return True
             return False
         except Exception as e:
-            self.log.info(f"Not accepting data with exception {e}")
+            self.log.info(f"{self.user_label}: Not accepting data with exception {e}")
             return False
-    def receive_data(self, data): # called from external updates
-        parsed = json.loads(data)
-        if self.accepts_data(data):
+    def is_unchanged(self, parsed):
+        # Same ok state as already reported, which would neither change nor alert anything
+        state = self.reported_state
+        return (state is self.state and state != None and state.is_ok and self.pending_data == None and "ttl" in parsed
+                and parsed.get("state_event") == state.name and parsed.get("remote_id") == self.remote_id
+                and parsed.get("remote_name") == self.remote_name)
+    def receive_data(self, parsed): # called from external updates
+        if self.accepts_data(parsed):
+            if self.is_unchanged(parsed) and self.bridgeWatcher.scheduler.reschedule(self, min(self.bridge.max_ttl, parsed["ttl"])):
+                # Only push back the next check
+                self.bridgeWatcher.absorbed += 1
+                return
             # Schedule an update
             self.pending_data = parsed
             self.update_now(self)
@@ -69,67 +260,71 @@ class BridgeWatcher(Looper, StatusPostCallback):
             if self.remote_id == None:
                 self.remote_id = parsed["remote_id"]
             elif self.remote_id != parsed["remote_id"]:
-                self.log.warning("remote_id mismatch ({self.remote_id}, {parsed['remote_id']})! did the user login a different account?")
+                self.log.warning(f"{self.user_label}: remote_id mismatch ({self.remote_id}, {parsed['remote_id']})! did the user login a different account?")
                 self.remote_id = parsed["remote_id"]
+                self.bridgeWatcher.update_route(self)
 
             # Check remote_name
             if self.remote_name == None:
                 self.remote_name = parsed["remote_name"]
             elif self.remote_name != parsed["remote_name"]:
-                self.log.warning("remote_name mismatch ({self.remote_name}, {parsed['remote_name']})! did the user login a different account?")
+                self.log.warning(f"{self.user_label}: remote_name mismatch ({self.remote_name}, {parsed['remote_name']})! did the user login a different account?")
                 self.remote_name = parsed["remote_name"]
 
-            self.state = parsed["state_event"]
+            self.state = get_bridge_state(parsed["state_event"])
             next_alert_ttl = self.update_callbacks()
 
-            return min(self.max_ttl, parsed["ttl"], next_alert_ttl)
+            return min(self.bridge.max_ttl, parsed["ttl"], next_alert_ttl)
         except Exception as e:
-            self.log.error(f"Error parsing {parsed}")
+            self.log.error(f"{self.user_label}: Error parsing {parsed}")
             raise e
 
     def update_callbacks(self):
-        is_good = self.state in GOOD_STATES
-        is_bad = self.state not in OK_STATES
+        bridge = self.bridge
+        state = self.state
         alert = False
-        next_alert_ttl = self.max_ttl
-        if is_bad:
-            now = datetime.now()
+        next_alert_ttl = bridge.max_ttl
+        if not state.is_ok:
+            now = time.time()
             if self.bad_since == None:
                 self.bad_since = now
-            if now >= self.bad_since + self.alert_delay:
-                if self.last_alert == None or now >= self.last_alert + self.alert_period:
+            if now >= self.bad_since + bridge.alert_delay:
+                if self.last_alert == None or now >= self.last_alert + bridge.alert_period:
                     alert = True
-                    next_alert_ttl = self.alert_period.seconds
+                    self.last_alert = now
+                    next_alert_ttl = int(bridge.alert_period)
                 else:
                     # Add 1 to ensure seconds are kind of rounded up (to avoid too frequent checks)
-                    next_alert_ttl = ((self.last_alert + self.alert_period) - now).seconds + 1
+                    next_alert_ttl = int(self.last_alert + bridge.alert_period - now) + 1
             else:
                 # Add 1 to ensure seconds are kind of rounded up (to avoid too frequent checks)
-                next_alert_ttl = ((self.bad_since + self.alert_delay) - now).seconds + 1
+                next_alert_ttl = int(self.bad_since + bridge.alert_delay - now) + 1
         else:
             self.bad_since = None
             self.last_alert = None
-        if alert:
-            self.last_alert = now
+        previous_state = self.reported_state.name if self.reported_state != None else None
+        bad_since = from_timestamp(self.bad_since)
         for callback in self.bridgeWatcher.callbacks:
             try:
-                callback.bridge_update(self.bridge_id, self.user_label, self.user_id, self.state, self.reported_state, is_good, is_bad, self.bad_since, alert)
+                callback.bridge_update(bridge.bridge_id, self.user_label, self.user_id, state.name, previous_state, state.is_good, not state.is_ok, bad_since, alert)
             except:
-                self.log.exception("Exception trying to update callback")
-        self.reported_state = self.state
+                self.log.exception(f"{self.user_label}: Exception trying to update callback")
+        self.reported_state = state
+        self.checkpoint()
         return next_alert_ttl
 
-    def fetch_status(self):
-        headers = {
-            "Authorization": f"Bearer {self.hs_token}"
-        }
-        args = parse.urlencode({
-            "user_id": self.user_id
-        })
-        data = parse.urlencode({}).encode()
-        req = request.Request(f"{self.bridge_url}?{args}", data=data, headers=headers)
-        resp = request.urlopen(req).read().decode()
-        parsed = json.loads(resp)
+    def offer_remote_state(self, remote_state):
+        # Status fetched for another watcher of the same user
+        if self.remote_id != None and self.remote_id in remote_state:
+            self.pending_data = remote_state[self.remote_id]
+        elif self.remote_id == None and len(remote_state) == 1:
+            self.pending_data = next(iter(remote_state.values()))
+        else:
+            return
+        self.update_now(self)
+
+    async def fetch_status(self):
+        parsed = await self.poller.fetch(self)
         remoteState = parsed["remoteState"]
         if self.remote_id != None:
             return self._handle_status(remoteState[self.remote_id])
@@ -138,48 +333,202 @@ class BridgeWatcher(Looper, StatusPostCallback):
         for remote_id in remoteState:
             return self._handle_status(remoteState[remote_id])
 
-    def update_loop(self):
+    async def update_loop(self):
         try:
             if self.pending_data != None:
                 result = self._handle_status(self.pending_data)
                 self.pending_data = None
-                self.identifiable = True
+                self.set_identifiable()
                 return result
-            elif self.bridge_url != None:
-                result = self.fetch_status()
-                self.identifiable = True
+            elif self.poller != None:
+                result = await self.fetch_status()
+                self.set_identifiable()
                 return result
             else:
                 # Not supported
-                return self.max_ttl
+                return self.bridge.max_ttl
+        except asyncio.CancelledError:
+            raise
+        except CircuitOpenError as e:
+            self.log.debug(f"{self.user_label}: {e}")
         except:
-            self.log.exception("Reading status failed")
-            self.state = "UNREACHABLE"
-            next_alert_ttl = self.update_callbacks()
-            return min(self.max_ttl, next_alert_ttl, self.ttl_if_unreachable)
+            self.log.exception(f"{self.user_label}: Reading status failed")
+        # Still report, so alerts go out as for any other bad state
+        self.state = get_bridge_state("UNREACHABLE")
+        next_alert_ttl = self.update_callbacks()
+        retry_in = self.bridge.ttl_if_unreachable
+        if self.poller != None:
+            retry_in = max(retry_in, self.poller.breaker.retry_in())
+        return min(self.bridge.max_ttl, next_alert_ttl, retry_in)
 
 
 class BridgesWatcher:
-    def __init__(self, config, callbacks):
+    def __init__(self, config, callbacks, state_store = None, sharding = None):
         self.log = logging.getLogger("BridgesWatcher")
-        self.bridge_watchers = []
+        # (bridge_id, user_label) -> BridgeWatcher
+        self.bridge_watchers = dict()
         self.callbacks = callbacks
+        self.state_store = state_store
+        self.sharding = sharding
+        # (user_id, remote_id) -> watchers, for routing pushed statuses
+        self.routes = dict()
+        # bridge_id -> BridgeConfig
+        self.bridge_configs = dict()
+        # Pushed statuses repeating the reported state, handled without an update
+        self.absorbed = 0
 
         m_config = config["bridge_status"]
-        bridges = m_config["bridges"]
+        self.bridges = m_config["bridges"]
+        # All watchers are run from one scheduler
+        self.scheduler = DeadlineScheduler("BridgesScheduler", m_config.get("poll_jitter", 0))
+        self.scheduler.start()
 
-        for bridge_id in bridges:
-            bridge = bridges[bridge_id]
+        for bridge_id in self.bridges:
+            self.bridge_configs[bridge_id] = BridgeConfig(bridge_id, self.bridges[bridge_id])
+        self.rebalance()
+        if sharding != None:
+            sharding.on_change(self.rebalance)
+        metrics.register_collector(self.collect_metrics)
+    def is_assigned(self, user_id):
+        return self.sharding == None or self.sharding.owns(bridge_user_key(user_id))
+    def rebalance(self, carried = None):
+        # Start the watchers this instance is responsible for, and stop those that moved to another shard.
+        # carried: (bridge_id, user_label) -> dumped state to continue from
+        started = 0
+        stopped = 0
+        for bridge_id in self.bridges:
+            bridge = self.bridges[bridge_id]
             for user_label in bridge["users"]:
                 user = bridge["users"][user_label]
                 user_id = user["user_id"]
-                remote_id = user["remote_id"] if ("remote_id" in user) else None
-                self.bridge_watchers.append(BridgeWatcher(bridge_id, bridge, user_label, user_id, remote_id, self))
+                watcher = self.bridge_watchers.get((bridge_id, user_label))
+                if self.is_assigned(user_id):
+                    if watcher == None:
+                        remote_id = user["remote_id"] if ("remote_id" in user) else None
+                        watcher = BridgeWatcher(self.bridge_configs[bridge_id], user_label, user_id, remote_id, self)
+                        if carried != None and (bridge_id, user_label) in carried:
+                            watcher.restore(carried[(bridge_id, user_label)])
+                        self.bridge_watchers[(bridge_id, user_label)] = watcher
+                        self.update_route(watcher)
+                        started += 1
+                elif watcher != None:
+                    self.stop_watcher(watcher)
+                    stopped += 1
+        if self.sharding != None or carried != None:
+            self.log.info(f"Watching {len(self.bridge_watchers)} bridge users, started {started}, stopped {stopped}")
+    def stop_watcher(self, watcher):
+        watcher.stop()
+        del self.bridge_watchers[(watcher.bridge_id, watcher.user_label)]
+        self.drop_route(watcher)
+    def watcher_config(self, bridges, bridge_id, user_label):
+        # Everything a watcher is built from, to tell whether it has to be rebuilt on reload
+        if bridge_id not in bridges or user_label not in bridges[bridge_id]["users"]:
+            return None
+        return (self.bridge_config(bridges, bridge_id), bridges[bridge_id]["users"][user_label])
+    def bridge_config(self, bridges, bridge_id):
+        if bridge_id not in bridges:
+            return None
+        return {key: value for key, value in bridges[bridge_id].items() if key != "users"}
+    def reload(self, config):
+        # Rebuild only watchers whose configuration changed, continuing from their current state
+        bridges = config["bridge_status"]["bridges"]
+        carried = dict()
+        for key, watcher in list(self.bridge_watchers.items()):
+            new_config = self.watcher_config(bridges, *key)
+            if new_config != self.watcher_config(self.bridges, *key):
+                self.stop_watcher(watcher)
+                if new_config != None and new_config[1]["user_id"] == watcher.user_id:
+                    # Only the same user continues from where it was
+                    carried[key] = watcher.dump()
+        for bridge_id in set(self.bridges) | set(bridges):
+            bridge_config = self.bridge_config(bridges, bridge_id)
+            if bridge_config != self.bridge_config(self.bridges, bridge_id):
+                old = self.bridge_configs.pop(bridge_id, None)
+                if old != None and old.poller != None:
+                    background_task(old.poller.close(), self.log)
+                if bridge_config != None:
+                    self.bridge_configs[bridge_id] = BridgeConfig(bridge_id, bridge_config)
+        self.bridges = bridges
+        self.rebalance(carried)
+    def collect_metrics(self):
+        states = []
+        is_good = []
+        bad_since = []
+        now = time.time()
+        for watcher in self.bridge_watchers.values():
+            labels = {"bridge": watcher.bridge_id, "user_label": watcher.user_label}
+            if watcher.state != None:
+                states.append((dict(labels, state=watcher.state.name), 1))
+                is_good.append((labels, 1 if watcher.state.is_good else 0))
+            if watcher.bad_since != None:
+                bad_since.append((labels, now - watcher.bad_since))
+        return [
+            ("bridge_observer_bridge_state", "Current state per bridge user", "gauge", states),
+            ("bridge_observer_bridge_good", "Whether the current state of a bridge user is good", "gauge", is_good),
+            ("bridge_observer_bridge_bad_seconds", "Time since a bridge user is not in a good state", "gauge", bad_since),
+            ("bridge_observer_scheduled_checks", "Bridge status checks waiting in the scheduler", "gauge", [({}, len(self.scheduler.deadlines))]),
+            ("bridge_observer_bridge_circuit_open", "Whether status requests to a bridge are paused after repeated failures", "gauge",
+                [({"bridge": bridge_id}, 0 if bridge.poller.breaker.state() == "closed" else 1)
+                    for bridge_id, bridge in self.bridge_configs.items() if bridge.poller != None]),
+            ("bridge_observer_status_absorbed_total", "Pushed statuses repeating the reported state, handled without an update", "counter", [({}, self.absorbed)]),
+        ]
+    def schedule(self):
+        # Upcoming status checks, soonest first
+        return [{
+            "bridge": watcher.bridge_id,
+            "user_label": watcher.user_label,
+            "in_seconds": round(delay, 1),
+        } for delay, watcher in self.scheduler.upcoming()]
+    def is_warm(self):
+        # Whether every polled watcher knows its state
+        return all(watcher.state != None for watcher in self.bridge_watchers.values() if watcher.poller != None)
+    def status(self):
+        # Current state of every bridge user, with epoch timestamps
+        now = time.time()
+        monotonic = time.monotonic()
+        status = []
+        for watcher in self.bridge_watchers.values():
+            deadline = self.scheduler.deadlines.get(watcher)
+            status.append({
+                "bridge": watcher.bridge_id,
+                "user_label": watcher.user_label,
+                "user_id": watcher.user_id,
+                "remote_id": watcher.remote_id,
+                "remote_name": watcher.remote_name,
+                "state": watcher.state.name if watcher.state != None else None,
+                "is_good": watcher.state.is_good if watcher.state != None else None,
+                "bad_since": watcher.bad_since,
+                "last_alert": watcher.last_alert,
+                "next_check": round(now + deadline - monotonic) if deadline != None else None,
+            })
+        return status
+    def drop_route(self, watcher):
+        old_key = watcher.route
+        watcher.route = None
+        if old_key != None:
+            self.routes[old_key].remove(watcher)
+            if len(self.routes[old_key]) == 0:
+                del self.routes[old_key]
+    def update_route(self, watcher):
+        key = watcher.route_key()
+        if key == watcher.route:
+            return
+        self.drop_route(watcher)
+        if key != None:
+            self.routes.setdefault(key, []).append(watcher)
+            watcher.route = key
     def receive_data(self, data):
-        accepters = []
-        for watcher in self.bridge_watchers:
-            if watcher.accepts_data(data):
-                accepters.append(watcher)
+        try:
+            key = (data["user_id"], data["remote_id"])
+        except Exception as e:
+            self.log.info(f"Not accepting data with exception {e}")
+            return
+        if not self.is_assigned(data["user_id"]):
+            if "forwarded_by" not in data:
+                self.sharding.forward(bridge_user_key(data["user_id"]), data)
+                return
+            self.log.debug(f"Status forwarded by {data['forwarded_by']} for a user not assigned here")
+        accepters = self.routes.get(key, [])
         if len(accepters) > 1:
             self.log.error(f"Discarding ambiguous update {data}")
             # Refresh all possibly relevant as fallback
@@ -0,0 +1,124 @@
+import asyncio
+from collections import deque
+import inspect
+import logging
+import time
+
+import metrics
+from util import background_task
+
+# Defaults for queued callback dispatch
+DISPATCH_QUEUE_SIZE = 1000
+DISPATCH_TIMEOUT_SECONDS = 30
+DISPATCH_SLOW_SECONDS = 5
+
+# Stands in for one subscriber (BridgeStatusUpdateCallback / WatchedUserUpdateCallback):
+# updates are queued and delivered by a worker task of its own, in the order they were reported,
+# so a slow subscriber holds up neither the watcher reporting the update nor the other subscribers.
+class QueuedCallback:
+    def __init__(self, callback, config):
+        self.callback = callback
+        self.name = type(callback).__name__
+        self.log = logging.getLogger(f"Dispatch_{self.name}")
+        self.max_size = config.get("queue_size", DISPATCH_QUEUE_SIZE)
+        self.timeout = config.get("timeout", DISPATCH_TIMEOUT_SECONDS)
+        self.slow = config.get("slow_warning", DISPATCH_SLOW_SECONDS)
+        # (method name, args)
+        self.pending = deque()
+        self.not_empty = asyncio.Event()
+        self.worker = None
+        self.delivered = 0
+        self.dropped = 0
+        self.timeouts = 0
+        # Whether the queue is more than half full, to warn only once per backlog
+        self.backlogged = False
+
+    def bridge_update(self, bridge, user_label, user_id, state, previous_state, is_good, is_bad, bad_since, alert):
+        self.put("bridge_update", (bridge, user_label, user_id, state, previous_state, is_good, is_bad, bad_since, alert))
+
+    def watched_user_update(self, user, bridge, is_good, alert, info):
+        self.put("watched_user_update", (user, bridge, is_good, alert, info))
+
+    def put(self, method, args):
+        if len(self.pending) >= self.max_size:
+            self.pending.popleft()
+            self.dropped += 1
+            self.log.warning(f"Queue of {self.name} full, dropped its oldest update")
+        self.pending.append((method, args))
+        if not self.backlogged and len(self.pending) > self.max_size / 2:
+            self.backlogged = True
+            self.log.warning(f"Slow subscriber {self.name}: {len(self.pending)} updates queued")
+        if self.worker == None:
+            self.worker = background_task(self.work(), self.log)
+        self.not_empty.set()
+
+    async def work(self):
+        while True:
+            while len(self.pending) == 0:
+                self.backlogged = False
+                self.not_empty.clear()
+                await self.not_empty.wait()
+            method, args = self.pending.popleft()
+            await self.deliver(method, args)
+
+    async def deliver(self, method, args):
+        start = time.monotonic()
+        try:
+            with metrics.CALLBACK_DURATION.time(callback = self.name):
+                result = getattr(self.callback, method)(*args)
+                if inspect.isawaitable(result):
+                    await asyncio.wait_for(result, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self.log.warning(f"{self.name}.{method} timed out after {self.timeout}s")
+        except asyncio.CancelledError:
+            raise
+        except:
+            self.log.exception(f"Exception in {self.name}.{method}")
+        self.delivered += 1
+        duration = time.monotonic() - start
+        if duration > self.slow:
+            self.log.warning(f"Slow subscriber {self.name}: {method} took {duration:.1f}s")
+
+    def stats(self):
+        return {
+            "depth": len(self.pending),
+            "max_size": self.max_size,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "timeouts": self.timeouts,
+        }
+
+# Hands out one QueuedCallback per subscriber, shared by all watchers it subscribed to
+class CallbackDispatcher:
+    def __init__(self, config):
+        self.config = config.get("dispatch", dict())
+        # callback -> QueuedCallback
+        self.queued = dict()
+        metrics.register_collector(self.collect_metrics)
+
+    def wrap(self, callbacks):
+        return [self.queue_for(callback) for callback in callbacks]
+
+    def queue_for(self, callback):
+        if callback not in self.queued:
+            self.queued[callback] = QueuedCallback(callback, self.config)
+        return self.queued[callback]
+
+    def stats(self):
+        return {queued.name: queued.stats() for queued in self.queued.values()}
+
+    def collect_metrics(self):
+        depth = []
+        dropped = []
+        timeouts = []
+        for queued in self.queued.values():
+            labels = {"callback": queued.name}
+            depth.append((labels, len(queued.pending)))
+            dropped.append((labels, queued.dropped))
+            timeouts.append((labels, queued.timeouts))
+        return [
+            ("bridge_observer_callback_queue_depth", "Updates waiting to be delivered to a callback", "gauge", depth),
+            ("bridge_observer_callback_dropped_total", "Updates dropped due to a full callback queue", "counter", dropped),
+            ("bridge_observer_callback_timeouts_total", "Callback deliveries that timed out", "counter", timeouts),
+        ]
@@ -0,0 +1,242 @@
+import asyncio
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from bridge_info import BridgeStatusUpdateCallback
+from mx_base import WatchedUserUpdateCallback
+from util import relative_path
+
+HISTORY_SEGMENT_SIZE = 4*1024*1024
+HISTORY_QUERY_DAYS = 7
+# timestamp, series id, state id, flags
+RECORD = struct.Struct("<dIHBx")
+FLAG_GOOD = 1
+FLAG_BAD = 2
+FLAG_ALERT = 4
+# State of a series at the time a segment was started, not a transition
+FLAG_CARRY = 8
+# State names of watched user series
+USER_GOOD = "GOOD"
+USER_BAD = "BAD"
+
+def bridge_series(bridge, user_label):
+    return f"bridge:{bridge}:{user_label}"
+
+def user_series(user, bridge):
+    return f"user:{user}:{bridge if bridge != None else ''}"
+
+# Append-only log of bridge state transitions and watched user good/alert flips.
+# Records have a fixed size and are appended in time order, so a time range is found by
+# binary search. The log is split into segments, each of which starts with the state of
+# every series at that time, so a query never has to look further back than one segment.
+class HistoryLog(BridgeStatusUpdateCallback, WatchedUserUpdateCallback):
+    def __init__(self, config, shard = None):
+        self.log = logging.getLogger("HistoryLog")
+        self.path = config.get("path", "history")
+        if not os.path.isabs(self.path):
+            self.path = relative_path(self.path)
+        if shard != None:
+            # Instances sharing a directory must not write to the same segments and catalog
+            self.path = os.path.join(self.path, shard)
+        self.segment_size = config.get("segment_size", HISTORY_SEGMENT_SIZE)
+        self.retention = config.get("retention_days", None)
+        os.makedirs(self.path, exist_ok=True)
+        self.catalog_path = os.path.join(self.path, "catalog.json")
+        # Series and state names are stored once in the catalog, records refer to them by index
+        self.series = dict()
+        self.states = dict()
+        if os.path.exists(self.catalog_path):
+            with open(self.catalog_path) as fin:
+                catalog = json.load(fin)
+            self.series = {name: i for i, name in enumerate(catalog["series"])}
+            self.states = {name: i for i, name in enumerate(catalog["states"])}
+        self.series_names = list(self.series)
+        self.state_names = list(self.states)
+        # series id -> (state id, flags) of the latest record
+        self.current = dict()
+        self.last_ts = 0
+        # Start timestamps and paths of all segments, oldest first
+        self.segments = sorted((int(name.split(".")[0]) / 1000, os.path.join(self.path, name))
+                for name in os.listdir(self.path) if name.endswith(".seg"))
+        if len(self.segments) > 0:
+            for ts, sid, state, flags in self.read_records(self.segments[-1][1]):
+                self.current[sid] = (state, flags & ~FLAG_CARRY)
+                self.last_ts = ts
+        self.out = None
+        self.catalog_changed = False
+        self.flush_scheduled = False
+
+    def get_id(self, ids, names, name):
+        if name not in ids:
+            ids[name] = len(names)
+            names.append(name)
+            self.catalog_changed = True
+        return ids[name]
+
+    def bridge_update(self, bridge, user_label, user_id, state, previous_state, is_good, is_bad, bad_since, alert):
+        if state != previous_state or alert:
+            self.record(bridge_series(bridge, user_label), state, is_good, is_bad, alert)
+
+    def watched_user_update(self, user, bridge, is_good, alert, info):
+        self.record(user_series(user, bridge), USER_GOOD if is_good else USER_BAD, is_good, not is_good, alert)
+
+    def record(self, series, state, is_good, is_bad, alert):
+        sid = self.get_id(self.series, self.series_names, series)
+        state_id = self.get_id(self.states, self.state_names, state)
+        flags = (FLAG_GOOD if is_good else 0) | (FLAG_BAD if is_bad else 0)
+        if self.current.get(sid) == (state_id, flags) and not alert:
+            return
+        # Keep records in time order, even if the clock goes back
+        ts = max(time.time(), self.last_ts)
+        if self.out == None or self.out.tell() >= self.segment_size:
+            self.rotate(ts)
+        self.out.write(RECORD.pack(ts, sid, state_id, flags | (FLAG_ALERT if alert else 0)))
+        self.current[sid] = (state_id, flags)
+        self.last_ts = ts
+        self.schedule_flush()
+
+    def rotate(self, ts):
+        if self.out != None:
+            self.out.close()
+        path = os.path.join(self.path, f"{int(ts*1000):015d}.seg")
+        self.out = open(path, "ab")
+        if self.out.tell() == 0:
+            for sid, (state_id, flags) in self.current.items():
+                self.out.write(RECORD.pack(ts, sid, state_id, flags | FLAG_CARRY))
+            self.segments.append((ts, path))
+        if self.retention != None:
+            # Drop segments which are completely older than the retention
+            while len(self.segments) > 1 and self.segments[1][0] < ts - self.retention*86400:
+                os.remove(self.segments.pop(0)[1])
+
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        try:
+            if self.catalog_changed:
+                self.catalog_changed = False
+                with open(self.catalog_path + ".tmp", "w") as fout:
+                    json.dump({"series": self.series_names, "states": self.state_names}, fout)
+                os.replace(self.catalog_path + ".tmp", self.catalog_path)
+            if self.out != None:
+                self.out.flush()
+        except:
+            self.log.exception("Failed to write history")
+
+    def read_records(self, path, start = None, end = None):
+        # Records of one segment within [start, end), found by binary search
+        with open(path, "rb") as fin:
+            size = os.fstat(fin.fileno()).st_size // RECORD.size * RECORD.size
+            if size == 0:
+                return
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                count = size // RECORD.size
+                timestamps = TimestampView(mm, count)
+                first = 0 if start == None else bisect.bisect_left(timestamps, start)
+                last = count if end == None else bisect.bisect_left(timestamps, end)
+                yield from RECORD.iter_unpack(mm[first*RECORD.size:last*RECORD.size])
+
+    def query(self, prefix, start, end):
+        # Intervals per series between start and end, and what they add up to
+        self.flush()
+        sids = {sid for sid, name in enumerate(self.series_names) if name.startswith(prefix)}
+        # sid -> [current state id, current flags, since, intervals of (start, end, state id, flags)]
+        tracked = dict()
+        first = max(0, bisect.bisect_right([segment[0] for segment in self.segments], start) - 1)
+        for i in range(first, len(self.segments)):
+            segment_start, path = self.segments[i]
+            if segment_start >= end:
+                break
+            if i == first:
+                # State at the start of the range
+                for ts, sid, state_id, flags in self.read_records(path, None, start):
+                    if sid in sids:
+                        tracked[sid] = [state_id, flags & ~(FLAG_CARRY | FLAG_ALERT), start, [], 0]
+            for ts, sid, state_id, flags in self.read_records(path, start, end):
+                if sid not in sids:
+                    continue
+                entry = tracked.get(sid)
+                if entry == None:
+                    entry = tracked[sid] = [state_id, flags, ts, [], 0]
+                elif entry[0] != state_id or entry[1] != flags & (FLAG_GOOD | FLAG_BAD):
+                    if ts > entry[2]:
+                        entry[3].append((entry[2], ts, entry[0], entry[1]))
+                    entry[0] = state_id
+                    entry[1] = flags & (FLAG_GOOD | FLAG_BAD)
+                    entry[2] = ts
+                if flags & FLAG_ALERT:
+                    entry[4] += 1
+        until = min(end, time.time())
+        result = dict()
+        for sid, (state_id, flags, since, intervals, alerts) in tracked.items():
+            if since < until:
+                intervals.append((since, until, state_id, flags))
+            result[self.series_names[sid]] = self.summarize(intervals, alerts, start, until)
+        return result
+
+    def summarize(self, intervals, alerts, start, until):
+        covered = sum(interval_end - interval_start for interval_start, interval_end, _, _ in intervals)
+        good = sum(interval_end - interval_start for interval_start, interval_end, _, flags in intervals if flags & FLAG_GOOD)
+        outages = []
+        for interval_start, interval_end, state_id, flags in intervals:
+            if not flags & FLAG_BAD:
+                continue
+            state = self.state_names[state_id]
+            if len(outages) > 0 and outages[-1]["end"] == interval_start:
+                outages[-1]["end"] = interval_end
+                if state not in outages[-1]["states"]:
+                    outages[-1]["states"].append(state)
+            else:
+                outages.append({"start": interval_start, "end": interval_end, "states": [state]})
+        down = 0
+        repairs = []
+        for outage in outages:
+            outage["seconds"] = outage["end"] - outage["start"]
+            down += outage["seconds"]
+            outage["ongoing"] = outage["end"] >= until
+            # Outages cut off by the range are of unknown length
+            if outage["start"] > start and not outage["ongoing"]:
+                repairs.append(outage["seconds"])
+        return {
+            "covered_seconds": covered,
+            "uptime_percent": 100 * (covered - down) / covered if covered > 0 else None,
+            "good_percent": 100 * good / covered if covered > 0 else None,
+            "alerts": alerts,
+            "mttr_seconds": sum(repairs) / len(repairs) if len(repairs) > 0 else None,
+            "outages": outages,
+        }
+
+    def query_view(self, query):
+        end = float(query.get("end", time.time()))
+        start = float(query.get("start", end - HISTORY_QUERY_DAYS*86400))
+        return self.query(query.get("series", ""), start, end)
+
+    def close(self):
+        self.flush()
+        if self.out != None:
+            self.out.close()
+            self.out = None
+
+# Sequence of the timestamps of the records in a segment, for bisect
+class TimestampView:
+    def __init__(self, mm, count):
+        self.mm = mm
+        self.count = count
+    def __len__(self):
+        return self.count
+    def __getitem__(self, i):
+        return struct.unpack_from("<d", self.mm, i*RECORD.size)[0]
+
+def open_history(config, sharding = None):
+    if "history" not in config:
+        return None
+    return HistoryLog(config["history"], sharding.name if sharding != None else None)
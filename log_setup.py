@@ -0,0 +1,127 @@
+import logging
+import os
+from logging import Formatter, StreamHandler
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+import queue
+import sys
+import time
+
+import metrics
+from util import relative_path
+
+# Defaults for the logging section
+LOG_FORMAT = "%(asctime)s: %(levelname)s: %(name)s: %(message)s"
+LOG_LEVEL = "DEBUG"
+LOG_QUEUE_SIZE = 10000
+# Debug records per logger and second, 0 for no limit
+LOG_DEBUG_RATE = 20
+LOG_DEBUG_BURST = 100
+LOG_ROTATE_WHEN = "d"
+LOG_ROTATE_INTERVAL = 1
+LOG_BACKUP_COUNT = 7
+
+# Token bucket per logger for records below INFO, so a chatty logger cannot flood the output
+class DebugRateLimit(logging.Filter):
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # logger name -> [tokens, last refill, suppressed since the last passed record]
+        self.buckets = dict()
+        # logger name -> suppressed records in total
+        self.suppressed = dict()
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.INFO:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.get(record.name)
+        if bucket == None:
+            bucket = self.buckets[record.name] = [self.burst, now, 0]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            self.suppressed[record.name] = self.suppressed.get(record.name, 0) + 1
+            return False
+        bucket[0] -= 1
+        if bucket[2] > 0:
+            record.msg = f"({bucket[2]} debug lines suppressed) {record.getMessage()}"
+            record.args = None
+            bucket[2] = 0
+        return True
+
+# Hands records to the writer thread without waiting, dropping them while the queue is full
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        # Dropped since the last record that made it into the queue
+        self.unreported = 0
+
+    def enqueue(self, record):
+        try:
+            if self.unreported > 0:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": "log_setup",
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": f"Log queue was full, dropped {self.unreported} records",
+                }))
+                self.unreported = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self.unreported += 1
+
+# Records are formatted where they are logged and written to stdout and the log file by a background thread
+class LogPipeline:
+    def __init__(self, config):
+        l_config = config.get("logging", dict())
+        formatter = Formatter(l_config.get("format", LOG_FORMAT))
+        handlers = []
+        stdout_handler = StreamHandler(sys.stdout)
+        stdout_handler.setFormatter(formatter)
+        stdout_handler.setLevel(l_config.get("stdout_level", LOG_LEVEL))
+        handlers.append(stdout_handler)
+        if l_config.get("file") != None:
+            path = l_config["file"]
+            if not os.path.isabs(path):
+                path = relative_path(path)
+            file_handler = TimedRotatingFileHandler(path,
+                    when=l_config.get("when", LOG_ROTATE_WHEN),
+                    interval=l_config.get("interval", LOG_ROTATE_INTERVAL),
+                    backupCount=l_config.get("backup_count", LOG_BACKUP_COUNT))
+            file_handler.setFormatter(formatter)
+            file_handler.setLevel(l_config.get("file_level", LOG_LEVEL))
+            handlers.append(file_handler)
+
+        self.rate_limit = DebugRateLimit(l_config.get("debug_rate", LOG_DEBUG_RATE), l_config.get("debug_burst", LOG_DEBUG_BURST))
+        self.queue_handler = DroppingQueueHandler(queue.Queue(l_config.get("queue_size", LOG_QUEUE_SIZE)))
+        self.queue_handler.addFilter(self.rate_limit)
+        self.listener = QueueListener(self.queue_handler.queue, *handlers, respect_handler_level=True)
+
+        root = logging.getLogger("")
+        root.setLevel(l_config.get("level", LOG_LEVEL))
+        root.addHandler(self.queue_handler)
+        for name, level in l_config.get("levels", dict()).items():
+            logging.getLogger(name).setLevel(level)
+        self.listener.start()
+        metrics.register_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        return [
+            ("bridge_observer_log_dropped_total", "Log records dropped because the log queue was full", "counter", [({}, self.queue_handler.dropped)]),
+            ("bridge_observer_log_suppressed_total", "Debug log records suppressed by the rate limit", "counter",
+                [({"logger": name}, count) for name, count in self.rate_limit.suppressed.items()]),
+            ("bridge_observer_log_queue_depth", "Log records waiting to be written", "gauge", [({}, self.queue_handler.queue.qsize())]),
+        ]
+
+    def stop(self):
+        # Writes out whatever is still queued
+        self.listener.stop()
+        if self.queue_handler.dropped > 0:
+            print(f"Dropped {self.queue_handler.dropped} log records due to a full log queue", file=sys.stderr)
+
+def setup_logging(config):
+    return LogPipeline(config)
@@ -1,25 +1,42 @@
 #!/usr/bin/env python3
 
+import time
+# For the startup report
+STARTED = time.monotonic()
+
+import asyncio
+import copy
 import logging
-from logging import Formatter, StreamHandler
-from logging.handlers import TimedRotatingFileHandler
+import os
+import signal
 import sys
 import yaml
 
+import metrics
 from bridge_info import BridgesWatcher
-from user_watch import UserWatcher
+from dispatch import CallbackDispatcher
+from history import open_history
+from log_setup import setup_logging
 from mx_notify import MatrixNotify
-from status_listener import StatusPostCallback, status_listen
-from util import relative_path as rp
-import nest_asyncio
+from sharding import open_sharding
+from state_store import open_state_store
+from status_listener import StatusPostCallback, StatusSnapshot, status_listen
+from util import PhaseTimer, background_task, wait_until, relative_path as rp
+# user_watch is imported once the status listener is up, as it pulls in nio
 
-mainlog = logging.getLogger("")
-mainlog.setLevel(logging.DEBUG)
 log = logging.getLogger("main")
-log.setLevel(logging.DEBUG)
 
-with open(rp('config.yaml')) as fin:
-    config = yaml.full_load(fin)
+CONFIG_PATH = rp('config.yaml')
+# Seconds between checks whether the config file changed
+CONFIG_CHECK_SECONDS = 5
+# Seconds to wait for the first complete status, per startup phase
+STARTUP_TIMEOUT_SECONDS = 120
+
+def load_config():
+    with open(CONFIG_PATH) as fin:
+        return yaml.full_load(fin)
+
+config = load_config()
 
 class StatusPrinter(StatusPostCallback):
     def receive_data(self, data):
@@ -31,52 +48,146 @@ class StatusPrinter(StatusPostCallback):
         else:
             log.info(log_msg)
 
-if __name__ == "__main__":
-    # Allow one matrix nio client invoke a callback for another one, both using their own asyncio loops
-    nest_asyncio.apply()
-    # TODO copy log config stuff as done in mautrix-*
-    logrotate = TimedRotatingFileHandler(
-            "/daten/links/matrix-bridges/bridge-observer/log", #get_path(config.get("logging", "file")),
-            when="d", #config.get("logging", "when"),
-            interval=1, #config.getint("logging", "interval"),
-            backupCount=7 #config.getint("logging", "backupCount")
-    )
-    logrotate.setFormatter(Formatter(
-            "%(asctime)s: %(levelname)s: %(name)s: %(message)s" #config.get("logging", "format", raw=True)
-    ))
-    logrotate.setLevel(logging.DEBUG)
-    #mainlog.addHandler(logrotate)
-    stdouthandler = StreamHandler(sys.stdout)
-    stdouthandler.setFormatter(Formatter(
-            "%(asctime)s: %(levelname)s: %(name)s: %(message)s" #config.get("logging", "stdout_format", raw=True)
-    ))
-    stdouthandler.setLevel(logging.DEBUG)
-    if sys.stdout.isatty() or True:
-        stdouthandler.setLevel(logging.DEBUG)
-    else:
-        # Be less verbose for systemd log
-        stdouthandler.setLevel(logging.WARNING)
-    mainlog.addHandler(stdouthandler)
+# Applies changes to watched users and bridge users without a restart, on SIGHUP or when the config file changes
+class ConfigReloader:
+    def __init__(self, config, bridgesWatcher, userWatcher):
+        # The config as read from the file, before any adjustments at startup
+        self.config = config
+        self.bridgesWatcher = bridgesWatcher
+        self.userWatcher = userWatcher
+        self.check_interval = config.get("config_check_interval", CONFIG_CHECK_SECONDS)
+        self.mtime = os.stat(CONFIG_PATH).st_mtime
+
+    def start(self):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload)
+        if self.check_interval > 0:
+            background_task(self.watch(), log)
 
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                mtime = os.stat(CONFIG_PATH).st_mtime
+            except OSError:
+                continue
+            if mtime != self.mtime:
+                # Only reload once the file stopped changing, so we do not read it while it is being written
+                await asyncio.sleep(self.check_interval)
+                try:
+                    if os.stat(CONFIG_PATH).st_mtime != mtime:
+                        continue
+                except OSError:
+                    continue
+                self.mtime = mtime
+                self.reload()
+
+    def reload(self):
+        log.info("Reloading configuration")
+        try:
+            new_config = load_config()
+            if "bridges" not in new_config["bridge_status"] or "watched_users" not in new_config:
+                raise Exception("bridge_status.bridges or watched_users missing")
+        except:
+            log.exception("Failed to read configuration, keeping the running one")
+            return
+        for key in set(self.config) | set(new_config):
+            if key not in ["bridge_status", "watched_users"] and self.config.get(key) != new_config.get(key):
+                log.warning(f"Changes to {key} need a restart")
+        for key in set(self.config["bridge_status"]) | set(new_config["bridge_status"]):
+            if key != "bridges" and self.config["bridge_status"].get(key) != new_config["bridge_status"].get(key):
+                log.warning(f"Changes to bridge_status.{key} need a restart")
+        try:
+            self.bridgesWatcher.reload(new_config)
+            self.userWatcher.reload(new_config)
+        except:
+            log.exception("Failed to apply configuration")
+        self.config = new_config
+
+async def main():
+    startup = PhaseTimer(STARTED)
+    metrics.register_collector(startup.collect_metrics)
+    startup.phase("imports")
+    # Compared with on reload, the running config may get adjusted below
+    file_config = copy.deepcopy(config)
+    state_store = open_state_store(config)
+    sharding = open_sharding(config)
+    history = open_history(config, sharding)
     mx_notifier = MatrixNotify(config)
     status_printer = StatusPrinter()
+    snapshot = StatusSnapshot(config)
+    # Subscribers get their updates through their own queue, so they cannot hold up the watchers
+    dispatcher = CallbackDispatcher(config)
 
     bridge_callbacks = [
         status_printer,
-        mx_notifier
+        mx_notifier,
+        snapshot
     ]
-    log.info("Starting bridge watchers...")
-    bridgesWatcher = BridgesWatcher(config, bridge_callbacks)
-
     user_callbacks = [
-        mx_notifier
+        mx_notifier,
+        snapshot
     ]
-    log.info("Starting user watchers...")
-    userWatcher = UserWatcher(config, user_callbacks)
+    if history != None:
+        bridge_callbacks.append(history)
+        user_callbacks.append(history)
+    bridge_callbacks = dispatcher.wrap(bridge_callbacks)
+    user_callbacks = dispatcher.wrap(user_callbacks)
+    startup.phase("setup")
 
+    log.info("Starting bridge watchers...")
+    bridgesWatcher = BridgesWatcher(config, bridge_callbacks, state_store, sharding)
+    snapshot.add_source("bridges", bridgesWatcher.status)
+    startup.phase("bridge watchers")
+
+    log.info("Starting status listener...")
     listen_callbacks = [
         StatusPrinter(),
         bridgesWatcher
     ]
-    log.info("Starting status listener...")
-    status_listen(listen_callbacks, config)
+    views = {
+        "/schedule": bridgesWatcher.schedule,
+        "/dispatch": dispatcher.stats,
+    }
+    if sharding != None:
+        log.info(f"Running as shard {sharding.name}")
+        # Every instance listens on the port of its own shard url
+        config["bridge_status"]["listen_endpoint"]["port"] = sharding.listen_port()
+        views["/shard"] = sharding.stats
+        sharding.start()
+    query_views = dict()
+    if history != None:
+        query_views["/history"] = history.query_view
+    # Pushes are accepted right away, and processed once the bridge watchers know their remote ids
+    bridges_ready = asyncio.Event()
+    await status_listen(listen_callbacks, config, views, query_views, snapshot, bridges_ready)
+    startup.phase("status listener")
+
+    from user_watch import UserWatcher
+    startup.phase("matrix client import")
+    log.info("Starting user watchers...")
+    userWatcher = UserWatcher(config, user_callbacks, state_store, sharding)
+    snapshot.add_source("watched_users", userWatcher.status)
+    reloader = ConfigReloader(file_config, bridgesWatcher, userWatcher)
+    reloader.start()
+    startup.phase("user watchers")
+
+    # Bridge status checks and initial syncs are all running by now
+    timeout = config.get("startup_timeout", STARTUP_TIMEOUT_SECONDS)
+    if not await wait_until(bridgesWatcher.is_warm, timeout):
+        log.warning(f"Not all bridge statuses known after {timeout}s")
+    bridges_ready.set()
+    startup.phase("bridge statuses")
+    if not await wait_until(userWatcher.is_warm, timeout):
+        log.warning(f"Not all watched users synced after {timeout}s")
+    startup.phase("initial syncs")
+    log.info(f"Startup: {startup.report()}; first complete status after {startup.total():.2f}s")
+
+    # Everything runs as tasks on this loop from here on
+    await asyncio.Event().wait()
+
+if __name__ == "__main__":
+    log_pipeline = setup_logging(config)
+    try:
+        asyncio.run(main())
+    finally:
+        log_pipeline.stop()
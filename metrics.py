@@ -0,0 +1,93 @@
+from contextlib import contextmanager
+import logging
+import time
+
+log = logging.getLogger("metrics")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+histograms = []
+# Functions returning a list of (name, help, type, [(labels, value)]) to be exported on each scrape
+collectors = []
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels.keys(), escaped)) + "}"
+
+class Histogram:
+    def __init__(self, name, help, buckets = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # label values -> [bucket counts..., sum, count]
+        self.series = dict()
+        histograms.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        if key not in self.series:
+            self.series[key] = [0] * (len(self.buckets) + 2)
+        series = self.series[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self.series.items():
+            labels = dict(key)
+            for i, bound in enumerate(self.buckets):
+                lines.append(f"{self.name}_bucket{format_labels(dict(labels, le=bound))} {series[i]}")
+            lines.append(f"{self.name}_bucket{format_labels(dict(labels, le='+Inf'))} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {series[-1]}")
+        return lines
+
+def register_collector(collector):
+    collectors.append(collector)
+
+def unregister_collector(collector):
+    if collector in collectors:
+        collectors.remove(collector)
+
+def render():
+    lines = []
+    for histogram in histograms:
+        lines += histogram.render()
+    # Several collectors may contribute samples to the same metric
+    families = dict()
+    for collector in collectors:
+        try:
+            collected = collector()
+        except:
+            log.exception("Metrics collector failed")
+            continue
+        for name, help, metric_type, samples in collected:
+            if name not in families:
+                families[name] = (help, metric_type, [])
+            families[name][2].extend(samples)
+    for name, (help, metric_type, samples) in families.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+SYNC_DURATION = Histogram("bridge_observer_sync_duration_seconds", "Duration of client.sync requests of watched users")
+GET_BRIDGES_DURATION = Histogram("bridge_observer_get_bridges_duration_seconds", "Duration of room state requests to classify rooms")
+BACKFILL_PAGE_DURATION = Histogram("bridge_observer_backfill_page_duration_seconds", "Duration of room_messages backfill requests")
+FETCH_STATUS_DURATION = Histogram("bridge_observer_fetch_status_duration_seconds", "Duration of bridge_state requests")
+ROOM_SEND_DURATION = Histogram("bridge_observer_room_send_duration_seconds", "Duration of sending notifications")
+CALLBACK_DURATION = Histogram("bridge_observer_callback_duration_seconds", "Time spent dispatching an update to a callback")
@@ -1,7 +1,32 @@
 import asyncio
 import logging
-from nio import AsyncClient
-from threading import Lock
+from datetime import datetime, timedelta
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from util import CircuitBreaker
+# nio is imported where it is used: it takes a while to import, and is not needed to get the status listener up
+
+# Defaults for the persistent client connection pool
+CLIENT_POOL_SIZE = 4
+CLIENT_KEEPALIVE_SECONDS = 60
+CLIENT_IDLE_CHECK_SECONDS = 300
+# Retries of a request after a timeout or connection error, before it fails (nio retries forever by default)
+CLIENT_MAX_TIMEOUTS = 2
+
+# Raised for responses which show the homeserver is in trouble (e.g. 5xx), rather than the request
+class HomeserverUnavailable(Exception):
+    pass
+
+class WatchedUserUpdateCallback:
+    def watched_user_update(self, user, bridge, is_good, alert, info):
+        pass
+
+# homeserver -> CircuitBreaker, shared by all accounts on it
+homeserver_breakers = dict()
+
+def homeserver_breaker(homeserver):
+    if homeserver not in homeserver_breakers:
+        homeserver_breakers[homeserver] = CircuitBreaker(f"homeserver {homeserver}")
+    return homeserver_breakers[homeserver]
 
 class BaseMatrixUser:
     def __init__(self, logname, config):
@@ -9,25 +34,93 @@ class BaseMatrixUser:
         self.mx_id = config["mx_id"]
         self.homeserver = config["homeserver"]
         self.token = config["token"]
-        self.loop = asyncio.new_event_loop()
-        self.client_lock = Lock()
+        self.pool_size = config.get("client_pool_size", CLIENT_POOL_SIZE)
+        self.keepalive = config.get("client_keepalive", CLIENT_KEEPALIVE_SECONDS)
+        self.idle_check = timedelta(seconds=config.get("client_idle_check", CLIENT_IDLE_CHECK_SECONDS))
+        self.max_timeouts = config.get("client_max_timeouts", CLIENT_MAX_TIMEOUTS)
+        self.breaker = homeserver_breaker(self.homeserver)
+        self.client_lock = asyncio.Lock()
+        self.client = None
+        self.client_last_used = None
+        # Connection metrics, to confirm the keep-alive pool is doing its job
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def client_config(self):
+        from nio import AsyncClientConfig
+        return AsyncClientConfig(max_timeouts=self.max_timeouts)
 
-    async def async_with_client(self, func):
-        client = None
+    def _create_client(self):
+        from nio import AsyncClient
+        async def on_connection_create_end(session, context, params):
+            self.connections_opened += 1
+        async def on_connection_reuseconn(session, context, params):
+            self.connections_reused += 1
+        trace = TraceConfig()
+        trace.on_connection_create_end.append(on_connection_create_end)
+        trace.on_connection_reuseconn.append(on_connection_reuseconn)
+        client = AsyncClient(self.homeserver, self.mx_id, config=self.client_config())
+        client.access_token = self.token
+        client.user_id = self.mx_id
+        # Provide our own session, so we control the keep-alive pool and can count connections
+        client.client_session = ClientSession(
+            timeout=ClientTimeout(total=client.config.request_timeout),
+            trace_configs=[trace],
+            connector=TCPConnector(limit_per_host=self.pool_size, keepalive_timeout=self.keepalive),
+        )
+        return client
+
+    async def _close_client(self):
+        client = self.client
+        self.client = None
+        if client != None:
+            try:
+                await client.close()
+            except:
+                pass
+
+    async def _get_client(self):
+        from nio import WhoamiError
+        async with self.client_lock:
+            now = datetime.now()
+            if self.client != None and now - self.client_last_used > self.idle_check:
+                # Health check connections that have been idle for a while, before relying on them
+                try:
+                    response = await self.client.whoami()
+                    if isinstance(response, WhoamiError):
+                        raise Exception(response.message)
+                except Exception as e:
+                    self.log.warning(f"Idle client failed health check, reconnecting: {e}")
+                    await self._close_client()
+            if self.client == None:
+                self.client = self._create_client()
+            self.client_last_used = now
+            return self.client
+
+    async def async_with_client(self, func, unavailable = None):
+        # Returns `unavailable` without a request while the homeserver is considered down, or if it failed
+        if not self.breaker.allow():
+            self.log.debug(f"Skipping request, {self.homeserver} unavailable for another {self.breaker.retry_in():.0f}s")
+            return unavailable
         try:
-            client = AsyncClient(self.homeserver, self.mx_id)
-            client.access_token = self.token
-            client.user_id = self.mx_id
-            return await func(client)
+            client = await self._get_client()
+            result = await func(client)
+            self.breaker.success()
+            return result
+        except asyncio.CancelledError:
+            self.breaker.abandon()
+            raise
+        except (ClientError, asyncio.TimeoutError, HomeserverUnavailable) as e:
+            self.breaker.failure()
+            self.log.warning(f"Homeserver request failed: {e!r}")
+            await self._close_client()
+            return unavailable
         except:
+            # Not the homeserver's fault, and must not leave a probe pending
+            self.breaker.success()
             self.log.exception("Failed to execute with matrix client")
+            # Reconnect transparently on next use
+            await self._close_client()
+            return unavailable
         finally:
-            if client != None:
-                try:
-                    await client.close()
-                except:
-                    pass
-
-    def with_client(self, func):
-        with self.client_lock:
-            return self.loop.run_until_complete(self.async_with_client(func))
+            self.log.debug(f"Client connections: opened={self.connections_opened}, reused={self.connections_reused}")
@@ -1,6 +1,15 @@
-from mx_base import BaseMatrixUser
+import asyncio
+import metrics
+from mx_base import BaseMatrixUser, HomeserverUnavailable, WatchedUserUpdateCallback
 from bridge_info import BridgeStatusUpdateCallback
-from user_watch import WatchedUserUpdateCallback
+from util import background_task
+
+# Fallback delay if the server rate-limits us without telling for how long
+RATE_LIMIT_DELAY_MS = 5000
+# Delay before retrying updates which could not be sent, e.g. while another account probes the homeserver
+UNAVAILABLE_DELAY_SECONDS = 5
+# Result of async_with_client when nothing was sent
+UNAVAILABLE = object()
 
 
 class MatrixNotify(BaseMatrixUser, BridgeStatusUpdateCallback, WatchedUserUpdateCallback):
@@ -9,6 +18,26 @@ class MatrixNotify(BaseMatrixUser, BridgeStatusUpdateCallback, WatchedUserUpdate
         super().__init__("MatrixNotify", m_config)
 
         self.room_id = m_config["room_id"]
+        # Updates arriving within this many seconds are merged into one digest message
+        self.coalesce_window = m_config.get("coalesce_window", 0)
+        # Pending updates: (group, msg, formatted_msg, alert)
+        self.pending = []
+        self.delivery_task = None
+        self.merged_updates = 0
+        metrics.register_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        return [
+            ("bridge_observer_notify_pending", "Updates waiting to be sent as notification", "gauge", [({}, len(self.pending))]),
+            ("bridge_observer_notify_merged_total", "Updates sent merged into a digest message", "counter", [({}, self.merged_updates)]),
+            ("bridge_observer_client_connections_opened_total", "Homeserver connections opened by an account's client", "counter", [({"user": self.mx_id}, self.connections_opened)]),
+            ("bridge_observer_client_connections_reused_total", "Homeserver connections reused by an account's client", "counter", [({"user": self.mx_id}, self.connections_reused)]),
+        ]
+
+    def client_config(self):
+        # Do not let nio sleep on rate limits, we handle them ourselves so we can keep merging updates meanwhile
+        from nio import AsyncClientConfig
+        return AsyncClientConfig(max_limit_exceeded=0, max_timeouts=self.max_timeouts)
 
     def bridge_update(self, bridge, user_label, user_id, state, previous_state, is_good, is_bad, bad_since, alert):
         if previous_state != state or alert:
@@ -18,15 +47,7 @@ class MatrixNotify(BaseMatrixUser, BridgeStatusUpdateCallback, WatchedUserUpdate
             # Bigger message, unless this is the first state that we heard since script start
             #if previous_state != None or alert:
             #    formatted_msg = f"<h4>{formatted_msg}</h4>"
-            async def update_fun(client):
-                content = {
-                    "msgtype": "m.text" if alert else "m.notice",
-                    "format": "org.matrix.custom.html",
-                    "body": msg,
-                    "formatted_body": formatted_msg
-                }
-                await client.room_send(self.room_id, "m.room.message", content, ignore_unverified_devices=True)
-            self.with_client(update_fun)
+            self.enqueue(bridge, msg, formatted_msg, alert)
 
     def get_color(self, is_good, is_bad):
         # Colors for good / not good same as sent from ruby-grafana
@@ -53,12 +74,71 @@ class MatrixNotify(BaseMatrixUser, BridgeStatusUpdateCallback, WatchedUserUpdate
                 msg_add += ": " + info
         msg += " " + msg_add
         formatted_msg += " " + msg_add
-        async def update_fun(client):
-            content = {
-                "msgtype": "m.text" if alert else "m.notice",
-                "format": "org.matrix.custom.html",
-                "body": msg,
-                "formatted_body": formatted_msg
-            }
-            await client.room_send(self.room_id, "m.room.message", content, ignore_unverified_devices=True)
-        self.with_client(update_fun)
+        self.enqueue(bridge if bridge != None else user, msg, formatted_msg, alert)
+
+    def enqueue(self, group, msg, formatted_msg, alert):
+        self.pending.append((group, msg, formatted_msg, alert))
+        if self.delivery_task == None:
+            self.delivery_task = background_task(self.deliver(), self.log)
+
+    async def deliver(self):
+        try:
+            while len(self.pending) > 0:
+                await asyncio.sleep(self.coalesce_window)
+                if self.breaker.retry_in() > 0:
+                    # Homeserver down, keep the updates until it may be back
+                    self.log.warning(f"Homeserver unavailable, retrying {len(self.pending)} updates in {self.breaker.retry_in():.0f}s")
+                    await asyncio.sleep(self.breaker.retry_in())
+                    continue
+                updates = self.pending
+                self.pending = []
+                retry_after_ms = await self.async_with_client(lambda client: self.send_digest(client, updates), unavailable = UNAVAILABLE)
+                if retry_after_ms is UNAVAILABLE:
+                    self.pending = updates + self.pending
+                    delay = max(UNAVAILABLE_DELAY_SECONDS, self.breaker.retry_in())
+                    self.log.warning(f"Homeserver unavailable, retrying {len(self.pending)} updates in {delay:.0f}s")
+                    await asyncio.sleep(delay)
+                elif retry_after_ms != None:
+                    # Keep the updates, they get merged with whatever arrives until we may send again
+                    self.pending = updates + self.pending
+                    self.log.warning(f"Rate limited, retrying {len(self.pending)} updates in {retry_after_ms}ms")
+                    await asyncio.sleep(retry_after_ms / 1000)
+        finally:
+            self.delivery_task = None
+
+    def format_digest(self, updates):
+        alert = any(update[3] for update in updates)
+        if len(updates) == 1:
+            return updates[0][1], updates[0][2], alert
+        groups = dict()
+        for group, msg, formatted_msg, _ in updates:
+            groups.setdefault(group, []).append((msg, formatted_msg))
+        msg = f"{len(updates)} updates"
+        formatted_msg = f"<b>{len(updates)} updates</b>"
+        for group in groups:
+            msg += f"\n{group}:\n" + "\n".join(m for m, _ in groups[group])
+            formatted_msg += f"<br><b>{group}</b><br>" + "<br>".join(f for _, f in groups[group])
+        return msg, formatted_msg, alert
+
+    async def send_digest(self, client, updates):
+        from nio import RoomSendError
+        msg, formatted_msg, alert = self.format_digest(updates)
+        content = {
+            "msgtype": "m.text" if alert else "m.notice",
+            "format": "org.matrix.custom.html",
+            "body": msg,
+            "formatted_body": formatted_msg
+        }
+        with metrics.ROOM_SEND_DURATION.time():
+            response = await client.room_send(self.room_id, "m.room.message", content, ignore_unverified_devices=True)
+        if isinstance(response, RoomSendError):
+            if response.status_code in ("M_LIMIT_EXCEEDED", 429):
+                return response.retry_after_ms or RATE_LIMIT_DELAY_MS
+            if response.transport_response != None and response.transport_response.status >= 500:
+                # Kept for another attempt
+                raise HomeserverUnavailable(f"Sending notification failed: {response.message}")
+            self.log.error(f"Failed to send notification for {len(updates)} updates: {response}")
+        elif len(updates) > 1:
+            self.merged_updates += len(updates)
+            self.log.info(f"Sent digest merging {len(updates)} updates")
+        return None
@@ -0,0 +1,241 @@
+import codecs
+import json
+import re
+from urllib.parse import urlencode
+
+from nio import Event
+from nio.api import MATRIX_API_PATH_V3
+from nio.responses import SyncError
+
+from util import BRIDGE_EVENT_TYPES, peak_rss, reset_peak_rss
+
+# Sync responses reduced to what the watched users look at: timeline events, bridge state and unread counts.
+# The classes have the attribute names of their nio counterparts, so rooms are handled the same either way.
+
+class RawTimeline:
+    __slots__ = ("events", "prev_batch")
+    def __init__(self, events, prev_batch):
+        self.events = events
+        self.prev_batch = prev_batch
+
+class RawUnreadNotifications:
+    __slots__ = ("notification_count", "highlight_count")
+    def __init__(self, notification_count, highlight_count):
+        self.notification_count = notification_count
+        self.highlight_count = highlight_count
+
+class RawJoinedRoom:
+    __slots__ = ("state", "timeline", "unread_notifications")
+    def __init__(self, state, timeline, unread_notifications):
+        self.state = state
+        self.timeline = timeline
+        self.unread_notifications = unread_notifications
+
+class RawRooms:
+    __slots__ = ("join", "leave")
+    def __init__(self, join, leave):
+        self.join = join
+        self.leave = leave
+
+class RawSyncResponse:
+    __slots__ = ("rooms", "next_batch", "size", "peak_rss")
+    def __init__(self, rooms, next_batch, size, peak_rss):
+        self.rooms = rooms
+        self.next_batch = next_batch
+        # Bytes of the response body
+        self.size = size
+        # Peak resident set size of the process while this response was parsed
+        self.peak_rss = peak_rss
+
+def parse_events(event_dicts, types = None):
+    events = []
+    for event_dict in event_dicts:
+        if types != None and event_dict.get("type") not in types:
+            continue
+        event = Event.parse_event(event_dict)
+        if event:
+            events.append(event)
+    return events
+
+def parse_joined_room(room_dict, keep_timeline):
+    # Bridge events are kept in any case, they decide whether the room matters
+    timeline_dict = room_dict.get("timeline", {})
+    unread = room_dict.get("unread_notifications", {})
+    return RawJoinedRoom(
+        parse_events(room_dict.get("state", {}).get("events", []), BRIDGE_EVENT_TYPES),
+        RawTimeline(parse_events(timeline_dict.get("events", []), None if keep_timeline else BRIDGE_EVENT_TYPES), timeline_dict.get("prev_batch")),
+        RawUnreadNotifications(unread.get("notification_count"), unread.get("highlight_count")))
+
+WHITESPACE = re.compile(r"\s*")
+STRING = re.compile(r'"(?:[^"\\]|\\.)*"')
+# Strings (skipped as a whole) and brackets within a container, a lone quote is a string that is not complete yet
+CONTAINER_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|"|[{}\[\]]')
+SCALAR_END = re.compile(r"[,}\]\s]")
+
+# Pull parser over a response body, which only holds on to the value being read and the chunk it is in.
+# Everything between two reads from the network runs without interruption, so the peak memory
+# measured over those stretches is this response's own, even while other syncs are in progress.
+class JsonStream:
+    def __init__(self, content):
+        self.content = content
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+        self.size = 0
+        self.eof = False
+        self.peak = None
+        reset_peak_rss()
+
+    def measure(self):
+        peak = peak_rss()
+        self.peak = peak if self.peak == None else max(self.peak, peak)
+
+    async def fill(self, keep):
+        # Reads the next chunk and drops the buffer before `keep`, returns how far positions moved
+        if self.eof:
+            raise ValueError("Unexpected end of sync response")
+        self.measure()
+        chunk = await self.content.readany()
+        reset_peak_rss()
+        if chunk == b"":
+            self.eof = True
+        self.size += len(chunk)
+        self.buf = self.buf[keep:] + self.decoder.decode(chunk, self.eof)
+        self.pos -= keep
+        return keep
+
+    async def peek(self):
+        # Next character after whitespace, without consuming it
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            await self.fill(self.pos)
+
+    async def expect(self, chars):
+        c = await self.peek()
+        if c not in chars:
+            raise ValueError(f"Unexpected {c!r} in sync response")
+        self.pos += 1
+        return c
+
+    async def read_string(self):
+        await self.expect('"')
+        self.pos -= 1
+        while True:
+            match = STRING.match(self.buf, self.pos)
+            if match != None:
+                self.pos = match.end()
+                return json.loads(match.group())
+            await self.fill(self.pos)
+
+    async def read_value(self, keep = True):
+        # Decodes the next value, or skips it without holding on to it
+        c = await self.peek()
+        if c == '"':
+            value = await self.read_string()
+            return value if keep else None
+        start = self.pos
+        if c not in "{[":
+            # Number, true, false or null
+            while True:
+                match = SCALAR_END.search(self.buf, self.pos)
+                if match != None or self.eof:
+                    break
+                start -= await self.fill(start)
+            self.pos = match.start() if match != None else len(self.buf)
+            return json.loads(self.buf[start:self.pos]) if keep else None
+        depth = 0
+        i = self.pos
+        while True:
+            match = CONTAINER_TOKEN.search(self.buf, i)
+            if match == None or match.group() == '"':
+                # The rest might be part of a string, continue from there with more data
+                resume = match.start() if match != None else len(self.buf)
+                shift = await self.fill(start if keep else resume)
+                start -= shift
+                i = resume - shift
+                continue
+            i = match.end()
+            c = match.group()[0]
+            if c == "{" or c == "[":
+                depth += 1
+            elif c == "}" or c == "]":
+                depth -= 1
+                if depth == 0:
+                    break
+        self.pos = i
+        return json.loads(self.buf[start:i]) if keep else None
+
+    async def read_object(self, on_member):
+        # Calls `await on_member(key)` for each member, which has to read or skip its value
+        await self.expect("{")
+        if await self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = await self.read_string()
+            await self.expect(":")
+            await on_member(key)
+            if await self.expect(",}") == "}":
+                return
+
+async def read_sync(stream, keep_timeline):
+    # Joined rooms are decoded one at a time and reduced right away, everything not looked at is skipped
+    join = dict()
+    leave = []
+    next_batch = None
+    async def joined_room(room_id):
+        join[room_id] = parse_joined_room(await stream.read_value(), keep_timeline(room_id))
+    async def left_room(room_id):
+        leave.append(room_id)
+        await stream.read_value(keep = False)
+    async def rooms_member(key):
+        if key == "join":
+            await stream.read_object(joined_room)
+        elif key == "leave":
+            await stream.read_object(left_room)
+        else:
+            await stream.read_value(keep = False)
+    async def member(key):
+        nonlocal next_batch
+        if key == "next_batch":
+            next_batch = await stream.read_value()
+        elif key == "rooms":
+            await stream.read_object(rooms_member)
+        else:
+            await stream.read_value(keep = False)
+    await stream.read_object(member)
+    if next_batch == None:
+        raise ValueError("next_batch missing in sync response")
+    stream.measure()
+    return RawSyncResponse(RawRooms(join, leave), next_batch, stream.size, stream.peak)
+
+async def raw_sync(client, since, timeout, sync_filter, keep_timeline):
+    # /sync without nio's response parsing and room bookkeeping, which keep everything in every room around.
+    # keep_timeline(room_id) tells whether the timeline of a room is needed, otherwise only bridge events are kept.
+    params = {"timeout": str(timeout)}
+    if since != None:
+        params["since"] = since
+    params["filter"] = sync_filter if isinstance(sync_filter, str) else json.dumps(sync_filter, separators=(",", ":"))
+    path = f"{MATRIX_API_PATH_V3}/sync?{urlencode(params)}"
+    response = await client.send("GET", path, headers = {"Authorization": f"Bearer {client.access_token}"},
+            timeout = timeout/1000 + client.config.request_timeout)
+    try:
+        if response.status == 200:
+            try:
+                return await read_sync(JsonStream(response.content), keep_timeline)
+            except ValueError as e:
+                parsed = {"error": f"Invalid sync response: {e}"}
+        else:
+            try:
+                parsed = await response.json(content_type = None)
+            except ValueError:
+                parsed = None
+            if not isinstance(parsed, dict):
+                parsed = dict()
+        error = SyncError(parsed.get("error", f"HTTP {response.status}"), parsed.get("errcode"))
+        error.transport_response = response
+        return error
+    finally:
+        response.release()
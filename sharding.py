@@ -0,0 +1,178 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+from urllib.parse import urlparse
+from aiohttp import ClientSession, ClientTimeout
+
+import metrics
+from util import background_task
+
+# Points per shard on the hash ring, more points spread the keys more evenly
+SHARD_VNODES = 64
+SHARD_CHECK_SECONDS = 10
+# Consecutive failed health checks after which a shard's keys are taken over by the others
+SHARD_MAX_FAILURES = 3
+SHARD_CHECK_TIMEOUT = 5
+# Overrides sharding.shard, so several instances can share one config file
+SHARD_ENV = "BRIDGE_OBSERVER_SHARD"
+
+def hash_key(key):
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], "big")
+
+# Bridge users are partitioned by their matrix user: one status request covers all of the user's bridge accounts
+def bridge_user_key(user_id):
+    return f"bridge_user:{user_id}"
+
+def watched_user_key(user_id):
+    return f"watched_user:{user_id}"
+
+# Consistent hashing: when a shard joins or leaves, only the keys next to its points change owner
+class HashRing:
+    def __init__(self, shards, vnodes = SHARD_VNODES):
+        self.points = sorted((hash_key(f"{shard}#{i}"), shard) for shard in shards for i in range(vnodes))
+        self.hashes = [point[0] for point in self.points]
+
+    def owner(self, key):
+        if len(self.points) == 0:
+            return None
+        return self.points[bisect.bisect(self.hashes, hash_key(key)) % len(self.points)][1]
+
+class ShardCoordinator:
+    def __init__(self, config):
+        self.log = logging.getLogger("Sharding")
+        s_config = config["sharding"]
+        # shard name -> base url of its status listener
+        self.shards = s_config["shards"]
+        self.name = os.environ.get(SHARD_ENV, s_config.get("shard"))
+        if self.name not in self.shards:
+            raise Exception(f"Unknown shard {self.name}, expected one of {list(self.shards)}")
+        self.vnodes = s_config.get("vnodes", SHARD_VNODES)
+        self.check_interval = s_config.get("check_interval", SHARD_CHECK_SECONDS)
+        self.max_failures = s_config.get("max_failures", SHARD_MAX_FAILURES)
+        # Assume every shard is up until proven otherwise, so a starting instance does not take over everything
+        self.alive = set(self.shards)
+        self.failures = dict()
+        self.ring = HashRing(self.alive, self.vnodes)
+        # Functions called after keys changed owner
+        self.listeners = []
+        self.session = None
+        self.task = None
+        # shard name -> statuses waiting to be forwarded
+        self.pending = dict()
+        self.flushing = set()
+        self.forwarded = 0
+        self.forward_failed = 0
+        metrics.register_collector(self.collect_metrics)
+
+    def listen_port(self):
+        return urlparse(self.shards[self.name]).port
+
+    def owner(self, key):
+        return self.ring.owner(key)
+
+    def owns(self, key):
+        return self.ring.owner(key) == self.name
+
+    def on_change(self, listener):
+        self.listeners.append(listener)
+
+    def get_session(self):
+        if self.session == None:
+            self.session = ClientSession(timeout=ClientTimeout(total=SHARD_CHECK_TIMEOUT))
+        return self.session
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.check_loop())
+
+    async def check_loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.check_shards()
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.log.exception("Checking shards failed")
+
+    async def check(self, shard):
+        try:
+            async with self.get_session().get(self.shards[shard] + "/shard") as response:
+                return response.status == 200
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log.debug(f"Shard {shard} failed health check: {e}")
+            return False
+
+    async def check_shards(self):
+        others = [shard for shard in self.shards if shard != self.name]
+        results = await asyncio.gather(*[self.check(shard) for shard in others])
+        alive = {self.name}
+        for shard, ok in zip(others, results):
+            self.failures[shard] = 0 if ok else self.failures.get(shard, 0) + 1
+            if self.failures[shard] < self.max_failures:
+                alive.add(shard)
+        if alive != self.alive:
+            self.log.info(f"Shards changed: {sorted(self.alive)} -> {sorted(alive)}")
+            self.alive = alive
+            self.ring = HashRing(alive, self.vnodes)
+            for listener in self.listeners:
+                try:
+                    listener()
+                except:
+                    self.log.exception("Rebalancing failed")
+
+    def forward(self, key, data):
+        # Statuses are forwarded only once, in case shards briefly disagree on the owner
+        shard = self.owner(key)
+        self.pending.setdefault(shard, []).append(dict(data, forwarded_by=self.name))
+        if shard not in self.flushing:
+            self.flushing.add(shard)
+            background_task(self.flush(shard), self.log)
+
+    async def flush(self, shard):
+        # One request at a time per shard keeps the order, whatever arrives meanwhile goes into the next one
+        try:
+            while len(self.pending.get(shard, [])) > 0:
+                batch = self.pending.pop(shard)
+                try:
+                    async with self.get_session().post(self.shards[shard] + "/", json=batch) as response:
+                        if response.status != 200:
+                            raise Exception(f"HTTP {response.status}")
+                    self.forwarded += len(batch)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.forward_failed += len(batch)
+                    self.log.warning(f"Failed to forward {len(batch)} statuses to shard {shard}: {e}")
+        finally:
+            self.flushing.discard(shard)
+
+    def stats(self):
+        return {
+            "shard": self.name,
+            "alive": sorted(self.alive),
+            "forwarded": self.forwarded,
+            "forward_failed": self.forward_failed,
+        }
+
+    def collect_metrics(self):
+        return [
+            ("bridge_observer_shards_alive", "Shards currently taking part in the partition", "gauge", [({}, len(self.alive))]),
+            ("bridge_observer_forwarded_total", "Pushed statuses forwarded to the owning shard", "counter", [({}, self.forwarded)]),
+            ("bridge_observer_forward_failed_total", "Pushed statuses that could not be forwarded", "counter", [({}, self.forward_failed)]),
+        ]
+
+    async def close(self):
+        if self.task != None:
+            self.task.cancel()
+        if self.session != None:
+            await self.session.close()
+            self.session = None
+
+def open_sharding(config):
+    if "sharding" not in config:
+        return None
+    return ShardCoordinator(config)
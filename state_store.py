@@ -0,0 +1,88 @@
+import asyncio
+from datetime import datetime
+import json
+import logging
+import os
+import sqlite3
+
+from util import relative_path
+
+def to_timestamp(dt):
+    return None if dt == None else dt.timestamp()
+
+def from_timestamp(ts):
+    return None if ts == None else datetime.fromtimestamp(ts)
+
+# Persists watcher state across restarts.
+# Values are JSON, stored per (kind, owner, key), e.g. ("sync_token", mx_id, "").
+# Only values that changed since they were last loaded or saved are written,
+# and all writes of one event loop iteration are committed together.
+class StateStore:
+    def __init__(self, path):
+        self.log = logging.getLogger("StateStore")
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS state (
+                kind TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (kind, owner, key)
+            )""")
+        self.db.commit()
+        # (kind, owner, key) -> last written JSON
+        self.saved = dict()
+        self.commit_scheduled = False
+
+    def load(self, kind, owner, key = ""):
+        row = self.db.execute("SELECT value FROM state WHERE kind = ? AND owner = ? AND key = ?", (kind, owner, key)).fetchone()
+        if row == None:
+            return None
+        self.saved[(kind, owner, key)] = row[0]
+        return json.loads(row[0])
+
+    def load_all(self, kind, owner):
+        result = dict()
+        for key, value in self.db.execute("SELECT key, value FROM state WHERE kind = ? AND owner = ?", (kind, owner)):
+            self.saved[(kind, owner, key)] = value
+            result[key] = json.loads(value)
+        return result
+
+    def save(self, kind, owner, key, value):
+        encoded = json.dumps(value, sort_keys=True)
+        if self.saved.get((kind, owner, key)) == encoded:
+            return
+        self.saved[(kind, owner, key)] = encoded
+        self.db.execute("INSERT OR REPLACE INTO state (kind, owner, key, value) VALUES (?, ?, ?, ?)", (kind, owner, key, encoded))
+        self.schedule_commit()
+
+    def delete(self, kind, owner, key = ""):
+        if self.saved.pop((kind, owner, key), None) == None:
+            return
+        self.db.execute("DELETE FROM state WHERE kind = ? AND owner = ? AND key = ?", (kind, owner, key))
+        self.schedule_commit()
+
+    def schedule_commit(self):
+        if not self.commit_scheduled:
+            self.commit_scheduled = True
+            asyncio.get_running_loop().call_soon(self.commit)
+
+    def commit(self):
+        self.commit_scheduled = False
+        try:
+            self.db.commit()
+        except:
+            self.log.exception("Failed to commit state")
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+def open_state_store(config):
+    if "state_store" not in config:
+        return None
+    path = config["state_store"]
+    if not os.path.isabs(path):
+        path = relative_path(path)
+    return StateStore(path)
@@ -1,29 +1,267 @@
 #!/usr/bin/env python3
 
-# TODO maybe instead use https://docs.aiohttp.org/en/stable/web_quickstart.html (and update readme)
-
-from flask import Flask, request
-from waitress import serve
+import asyncio
+from aiohttp import web
+from collections import OrderedDict
+import hashlib
+import json
 import logging
+import time
+
+import metrics
 
 log = logging.getLogger("status_listener")
-log.setLevel(logging.DEBUG)
+
+QUEUE_SIZE = 1000
+# merge: replace queued statuses for the same (user_id, remote_id), drop the oldest entry if still full
+# drop_oldest: drop the oldest queued status if full
+# reject: answer with 503 if full, so the bridge retries later
+# block: only acknowledge once there is room in the queue
+QUEUE_POLICIES = ["merge", "drop_oldest", "reject", "block"]
+# Defaults for GET /status
+STATUS_REFRESH_SECONDS = 10
+STATUS_MIN_INTERVAL_SECONDS = 1
 
 class StatusPostCallback:
+    __slots__ = ()
+    # data is a single parsed status payload
     def receive_data(self, data):
         pass
 
-def status_listen(callbacks, config):
-    m_config = config["bridge_status"]["listen_endpoint"]
-    app = Flask(__name__)
+class StatusQueue:
+    def __init__(self, config):
+        self.max_size = config.get("queue_size", QUEUE_SIZE)
+        self.policy = config.get("queue_policy", "merge")
+        if self.policy not in QUEUE_POLICIES:
+            raise Exception(f"Unknown queue_policy {self.policy}, expected one of {QUEUE_POLICIES}")
+        # key -> (enqueue time, payload)
+        self.pending = OrderedDict()
+        self.seq = 0
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.received = 0
+        self.merged = 0
+        self.dropped = 0
+        self.processed = 0
+        self.lag = 0
+        self.max_lag = 0
+
+    def key(self, payload):
+        if self.policy == "merge" and isinstance(payload, dict) and "user_id" in payload and "remote_id" in payload:
+            return (payload["user_id"], payload["remote_id"])
+        self.seq += 1
+        return self.seq
+
+    async def put(self, payload):
+        self.received += 1
+        key = self.key(payload)
+        while True:
+            if key in self.pending:
+                # Keep queue position and enqueue time, only the newest status is of interest
+                self.pending[key] = (self.pending[key][0], payload)
+                self.merged += 1
+                return True
+            if len(self.pending) < self.max_size:
+                break
+            if self.policy == "block":
+                self.not_full.clear()
+                await self.not_full.wait()
+            elif self.policy == "reject":
+                self.dropped += 1
+                return False
+            else:
+                self.pending.popitem(last=False)
+                self.dropped += 1
+        self.pending[key] = (time.monotonic(), payload)
+        self.not_empty.set()
+        return True
+
+    async def put_all(self, payloads):
+        # Returns False if any payload was rejected
+        if self.policy == "reject" and len(self.pending) + len(payloads) > self.max_size:
+            # Rejected as a whole, the bridge retries the whole batch
+            self.received += len(payloads)
+            self.dropped += len(payloads)
+            return False
+        accepted = True
+        for payload in payloads:
+            if not await self.put(payload):
+                accepted = False
+        return accepted
+
+    async def get(self):
+        while len(self.pending) == 0:
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        key, (enqueued, payload) = self.pending.popitem(last=False)
+        self.not_full.set()
+        self.lag = time.monotonic() - enqueued
+        self.max_lag = max(self.max_lag, self.lag)
+        return payload
+
+    def collect_metrics(self):
+        return [
+            ("bridge_observer_status_queue_depth", "Pushed statuses waiting to be processed", "gauge", [({}, len(self.pending))]),
+            ("bridge_observer_status_queue_lag_seconds", "Time the last processed status waited in the queue", "gauge", [({}, self.lag)]),
+            ("bridge_observer_status_received_total", "Pushed statuses received", "counter", [({}, self.received)]),
+            ("bridge_observer_status_merged_total", "Pushed statuses merged into a queued one", "counter", [({}, self.merged)]),
+            ("bridge_observer_status_dropped_total", "Pushed statuses dropped or rejected due to a full queue", "counter", [({}, self.dropped)]),
+        ]
+
+    def stats(self):
+        return {
+            "depth": len(self.pending),
+            "max_size": self.max_size,
+            "policy": self.policy,
+            "received": self.received,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "processed": self.processed,
+            "lag": self.lag,
+            "max_lag": self.max_lag,
+        }
+
+# Current state of all watchers, served by GET /status.
+# Built from the sources after updates (at most every min_interval seconds) and every refresh_interval
+# seconds, for what changes without an update. Requests only ever read the last finished snapshot.
+class StatusSnapshot:
+    def __init__(self, config):
+        s_config = config.get("status_api", dict())
+        self.refresh_interval = s_config.get("refresh_interval", STATUS_REFRESH_SECONDS)
+        self.min_interval = s_config.get("min_interval", STATUS_MIN_INTERVAL_SECONDS)
+        # name -> function returning a JSON-serializable result
+        self.sources = dict()
+        # (etag, body), replaced as a whole and never modified
+        self.current = None
+        self.last_build = 0
+        self.build_handle = None
+        self.task = None
+        self.builds = 0
+
+    def add_source(self, name, source):
+        self.sources[name] = source
+
+    def bridge_update(self, bridge, user_label, user_id, state, previous_state, is_good, is_bad, bad_since, alert):
+        self.mark_changed()
+
+    def watched_user_update(self, user, bridge, is_good, alert, info):
+        self.mark_changed()
+
+    def mark_changed(self):
+        if self.build_handle == None:
+            delay = max(0, self.last_build + self.min_interval - time.monotonic())
+            self.build_handle = asyncio.get_running_loop().call_later(delay, self.build)
 
-    @app.route('/', methods=['POST'])
-    def request_post():
+    def build(self):
+        self.build_handle = None
+        self.last_build = time.monotonic()
+        try:
+            body = json.dumps({name: source() for name, source in self.sources.items()}).encode()
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            if self.current == None or self.current[0] != etag:
+                self.current = (etag, body)
+                self.builds += 1
+        except:
+            log.exception("Building status snapshot failed")
+
+    def start(self):
+        self.build()
+        self.task = asyncio.get_running_loop().create_task(self.refresh_loop())
+
+    async def refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            self.mark_changed()
+
+def etag_matches(etag, if_none_match):
+    if if_none_match == None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+def parse_payloads(body):
+    # Single JSON status, JSON array of statuses, or newline-delimited JSON
+    try:
+        parsed = json.loads(body)
+        return parsed if isinstance(parsed, list) else [parsed]
+    except ValueError:
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+async def process_queue(queue, callbacks, ready):
+    if ready != None:
+        # Pushes stay queued until the watchers are ready for them
+        await ready.wait()
+    while True:
+        data = await queue.get()
         for callback in callbacks:
             try:
-                callback.receive_data(request.data)
+                with metrics.CALLBACK_DURATION.time(callback = type(callback).__name__):
+                    callback.receive_data(data)
             except:
                 log.exception("Callback update failed")
-        return 'ack'
+        queue.processed += 1
+
+# views: additional read-only endpoints, path -> function returning a JSON-serializable result
+# query_views: the same, but the function is passed the query parameters as a dict
+# snapshot: StatusSnapshot served on /status
+# ready: asyncio.Event after which queued pushes are processed, if they have to wait for the watchers
+async def status_listen(callbacks, config, views = dict(), query_views = dict(), snapshot = None, ready = None):
+    m_config = config["bridge_status"]["listen_endpoint"]
+    app = web.Application()
+    queue = StatusQueue(m_config)
+    metrics.register_collector(queue.collect_metrics)
+
+    async def request_post(request):
+        try:
+            payloads = parse_payloads(await request.read())
+        except ValueError as e:
+            log.warning(f"Discarding unparsable status push: {e}")
+            return web.Response(status=400, text='invalid json')
+        if not await queue.put_all(payloads):
+            log.warning("Status queue full, rejected pushed status")
+            return web.Response(status=503, text='queue full')
+        return web.Response(text='ack')
+
+    async def request_queue(request):
+        return web.json_response(queue.stats())
+
+    async def request_metrics(request):
+        return web.Response(body=metrics.render().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def request_status(request):
+        etag, body = snapshot.current
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if etag_matches(etag, request.headers.get("If-None-Match")):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type="application/json", headers=headers)
+
+    def json_view(view):
+        async def request_view(request):
+            return web.json_response(view())
+        return request_view
+
+    def json_query_view(view):
+        async def request_view(request):
+            try:
+                return web.json_response(view(dict(request.query)))
+            except ValueError as e:
+                return web.Response(status=400, text=str(e))
+        return request_view
+
+    app.router.add_post('/', request_post)
+    app.router.add_get('/queue', request_queue)
+    app.router.add_get('/metrics', request_metrics)
+    for path in views:
+        app.router.add_get(path, json_view(views[path]))
+    for path in query_views:
+        app.router.add_get(path, json_query_view(query_views[path]))
+    if snapshot != None:
+        snapshot.start()
+        app.router.add_get('/status', request_status)
 
-    serve(app, host = m_config["host"], port = m_config["port"])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host = m_config["host"], port = m_config["port"])
+    await site.start()
+    app["processor"] = asyncio.get_running_loop().create_task(process_queue(queue, callbacks, ready))
+    return runner
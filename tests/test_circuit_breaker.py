@@ -0,0 +1,74 @@
+import time
+
+from util import CircuitBreaker, CircuitOpenError
+
+def open_breaker():
+    breaker = CircuitBreaker("test", failures = 2, base_delay = 10, max_delay = 100)
+    breaker.failure()
+    breaker.failure()
+    return breaker
+
+def expire(breaker):
+    # Skip the backoff
+    breaker.open_until = time.monotonic() - 1
+
+def test_opens_after_failures_in_a_row():
+    breaker = CircuitBreaker("test", failures = 2)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state() == "closed" and breaker.allow()
+    breaker.failure()
+    assert breaker.state() == "open"
+    assert not breaker.allow()
+    assert breaker.short_circuited == 1
+    assert 2.5 <= breaker.retry_in() <= 5
+
+def test_check_raises_while_open():
+    breaker = open_breaker()
+    try:
+        breaker.check()
+        assert False
+    except CircuitOpenError:
+        pass
+
+def test_single_probe_when_half_open():
+    breaker = open_breaker()
+    expire(breaker)
+    assert breaker.state() == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    assert breaker.state() == "half_open"
+
+def test_successful_probe_closes():
+    breaker = open_breaker()
+    expire(breaker)
+    breaker.allow()
+    assert breaker.success()
+    assert breaker.state() == "closed" and breaker.allow()
+    assert breaker.openings == 0
+
+def test_failed_probe_reopens_with_longer_backoff():
+    breaker = open_breaker()
+    expire(breaker)
+    breaker.allow()
+    breaker.failure()
+    assert breaker.state() == "open"
+    assert breaker.openings == 2
+    assert 10 <= breaker.retry_in() <= 20
+
+def test_late_failure_does_not_extend_open_circuit():
+    breaker = open_breaker()
+    open_until = breaker.open_until
+    breaker.failure()
+    assert breaker.open_until == open_until
+
+def test_abandoned_probe_lets_another_probe_through():
+    breaker = open_breaker()
+    expire(breaker)
+    assert breaker.allow()
+    # The probe was cancelled
+    breaker.abandon()
+    assert breaker.state() == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
@@ -1,27 +1,53 @@
+import asyncio
 from datetime import datetime, timedelta
-from mx_base import BaseMatrixUser
-from nio.responses import SyncError, SyncResponse
+import logging
+import time
+import metrics
+from mx_base import BaseMatrixUser, HomeserverUnavailable, WatchedUserUpdateCallback, homeserver_breakers
+from sharding import watched_user_key
+from state_store import from_timestamp, to_timestamp
+from nio.responses import SyncError, SyncResponse, UploadFilterResponse
 from nio import RoomMessage, MegolmEvent, RoomMessagesResponse, MessageDirection
-from util import Looper, get_bridges
+from raw_sync import RawSyncResponse, raw_sync
+from util import BRIDGE_EVENT_TYPES, Looper, background_task, get_bridges, get_bridge_ids, get_bridges_from_events, is_bridge_event
 
 SYNC_TIMEOUT_MILLIS = 30_000
 SYNC_DELAY_SECONDS = 5
-
-class WatchedUserUpdateCallback:
-    def watched_user_update(self, user, bridge, is_good, alert, info):
-        pass
+# Timeline events per room and sync, the latest bridged message is usually among them
+SYNC_TIMELINE_LIMIT = 10
+BACKFILL_CONCURRENCY = 8
+BACKFILL_PAGE_SIZE = 50
+# Initial (full) syncs running at the same time, over all watched users
+INITIAL_SYNC_CONCURRENCY = 4
+# Evaluate a bit after a deadline, as maybe_update_callback compares strictly
+EVALUATION_MARGIN = timedelta(seconds = 1)
+# Settings of a watched user which need a new client, and thus a restart of the user when changed
+ACCOUNT_KEYS = ["homeserver", "mx_id", "token", "client_pool_size", "client_keepalive", "client_idle_check", "client_max_timeouts"]
+# Event types that can be bridged messages (RoomMessage and MegolmEvent)
+MESSAGE_EVENT_TYPES = ["m.room.message", "m.room.encrypted"]
 
 class UserBridgeState:
+    __slots__ = ("log", "bridge_id", "alert_after_inactivity", "alert_period", "last_update_was_good", "last_alert_ts",
+            "last_not_good_notify_ts", "posted_any_update", "last_bridged_message_ts", "changed", "last_evaluation",
+            "explicit_rooms", "require_sender", "send_on_inactivity", "inactivity_delay", "last_inactivity_send_ts",
+            "inactivity_send_user", "inactivity_send_room", "inactivity_send_text")
     def __init__(self, bridge_id, config, log):
         self.log = log
         self.bridge_id = bridge_id
-        self.alert_after_inactivity = timedelta(seconds = config["alert_after_inactivity"])
-        self.alert_period = timedelta(seconds = config["alert_period"])
         self.last_update_was_good = True
         self.last_alert_ts = None
         self.last_not_good_notify_ts = None
         self.posted_any_update = False
         self.last_bridged_message_ts = 0
+        # Whether a newer bridged message arrived since the last evaluation
+        self.changed = False
+        self.last_evaluation = None
+        self.last_inactivity_send_ts = None
+        self.configure(config)
+    def configure(self, config):
+        # Also used on reload, in place, as room checks still running keep updating this object
+        self.alert_after_inactivity = timedelta(seconds = config["alert_after_inactivity"])
+        self.alert_period = timedelta(seconds = config["alert_period"])
         if "explicit_rooms" in config:
             self.explicit_rooms = config["explicit_rooms"]
         else:
@@ -34,7 +60,6 @@ class UserBridgeState:
         if self.send_on_inactivity:
             inactivity_config = config["send_on_inactivity"]
             self.inactivity_delay = timedelta(seconds = inactivity_config["delay_alert"])
-            self.last_inactivity_send_ts = None
             self.inactivity_send_user = inactivity_config["send_user"]
             self.inactivity_send_room = inactivity_config["send_room"]
             self.inactivity_send_text = inactivity_config["send_text"]
@@ -46,12 +71,51 @@ class UserBridgeState:
         if self.require_sender != None and self.require_sender != event.sender:
             return False
         if isinstance(event, RoomMessage) or isinstance(event, MegolmEvent):
-            self.last_bridged_message_ts = max(event.server_timestamp, self.last_bridged_message_ts)
+            if event.server_timestamp > self.last_bridged_message_ts:
+                self.last_bridged_message_ts = event.server_timestamp
+                self.changed = True
             return True
         return False
+    def dump(self):
+        return {
+            "last_update_was_good": self.last_update_was_good,
+            "last_alert_ts": to_timestamp(self.last_alert_ts),
+            "last_not_good_notify_ts": to_timestamp(self.last_not_good_notify_ts),
+            "posted_any_update": self.posted_any_update,
+            "last_bridged_message_ts": self.last_bridged_message_ts,
+            "last_inactivity_send_ts": to_timestamp(self.last_inactivity_send_ts) if self.send_on_inactivity else None,
+        }
+    def restore(self, data):
+        self.last_update_was_good = data["last_update_was_good"]
+        self.last_alert_ts = from_timestamp(data["last_alert_ts"])
+        self.last_not_good_notify_ts = from_timestamp(data["last_not_good_notify_ts"])
+        self.posted_any_update = data["posted_any_update"]
+        self.last_bridged_message_ts = data["last_bridged_message_ts"]
+        if self.send_on_inactivity:
+            self.last_inactivity_send_ts = from_timestamp(data["last_inactivity_send_ts"])
+    def deadlines(self):
+        # Points in time at which maybe_update_callback can come to a new result without any new message
+        deadlines = [datetime.fromtimestamp(self.last_bridged_message_ts/1000) + self.alert_after_inactivity]
+        if self.last_alert_ts != None:
+            deadlines.append(self.last_alert_ts + self.alert_period)
+        if self.send_on_inactivity and self.last_inactivity_send_ts != None:
+            deadlines.append(self.last_inactivity_send_ts + self.inactivity_delay)
+        return [deadline + EVALUATION_MARGIN for deadline in deadlines]
+    def needs_evaluation(self, now):
+        if self.changed or not self.posted_any_update:
+            return True
+        for deadline in self.deadlines():
+            if deadline <= now and (self.last_evaluation == None or deadline > self.last_evaluation):
+                return True
+        return False
+    def next_evaluation(self, now):
+        upcoming = [deadline for deadline in self.deadlines() if deadline > now]
+        return min(upcoming) if len(upcoming) > 0 else None
     def oldest_interesting_timestamp(self, now):
         return int((now - self.alert_after_inactivity).timestamp()*1000)
     async def maybe_update_callback(self, now, watched_user, client):
+        self.changed = False
+        self.last_evaluation = now
         last_bridged_message_ts = datetime.fromtimestamp(self.last_bridged_message_ts/1000)
         alert =  now - last_bridged_message_ts > self.alert_after_inactivity
         post_update = False
@@ -119,6 +183,28 @@ class WatchedUser(BaseMatrixUser, Looper):
         Looper.__init__(self, logname)
         self.user_id = user_id
         self.userWatcher = userWatcher
+        self.bridge_states = dict()
+        self.bridge_configs = dict()
+        # room_id -> bridge protocol ids, as found in the room state
+        self.room_bridge_ids = dict()
+        self.sync_filter = None
+        self.sync_filter_id = None
+        self.sync_next_batch_token = None
+        # Set when rooms from before need another look, done with the next sync
+        self.full_sync_requested = False
+        # Whether the first round of checks is done (successful or not)
+        self.checked = False
+        # Size of the last sync response, and with raw_sync the peak memory of the process while it was parsed
+        self.last_sync_bytes = None
+        self.last_sync_peak_rss = None
+        self.state_store = userWatcher.state_store
+        self.apply_config(config)
+        if self.state_store != None:
+            self.restore()
+        self.start_loop(self.update_loop)
+
+    def apply_config(self, config):
+        # Also used on reload: bridge states are kept, and only reconfigured if their config changed
         if "watched_bridge_ids" in config:
             wbc = config["watched_bridge_ids"]
         else:
@@ -132,130 +218,312 @@ class WatchedUser(BaseMatrixUser, Looper):
             self.auto_mark_read_rooms_without_notification = config["auto_mark_read_rooms_without_notification"]
         else:
             self.auto_mark_read_rooms_without_notification = []
-        self.watched_bridge_ids = wbc.keys()
-        self.bridge_states = dict()
+        self.watched_bridge_ids = list(wbc.keys())
+        old_configs = self.bridge_configs
+        self.bridge_configs = wbc
+        resync = False
+        for bridge_id in list(self.bridge_states):
+            if bridge_id not in wbc:
+                del self.bridge_states[bridge_id]
+                if self.state_store != None:
+                    self.state_store.delete("user_bridge_state", self.mx_id, bridge_id)
         for x in wbc:
-            self.bridge_states[x] = UserBridgeState(x, wbc[x], self.log)
-        self.sync_next_batch_token = None
-        self.start_loop(self.update_loop)
+            if x in self.bridge_states and old_configs.get(x) == wbc[x]:
+                continue
+            if x in self.bridge_states:
+                bridge_state = self.bridge_states[x]
+                bridge_state.configure(wbc[x])
+                # Re-evaluate with the new thresholds
+                bridge_state.changed = True
+                old_config = old_configs[x]
+                if old_config.get("explicit_rooms") != wbc[x].get("explicit_rooms") or old_config.get("require_sender") != wbc[x].get("require_sender"):
+                    resync = True
+            else:
+                bridge_state = UserBridgeState(x, wbc[x], self.log)
+                if self.state_store != None:
+                    data = self.state_store.load("user_bridge_state", self.mx_id, x)
+                    if data != None:
+                        bridge_state.restore(data)
+                resync = True
+            self.bridge_states[x] = bridge_state
+        if resync and self.sync_next_batch_token != None:
+            # Rooms are only looked at when they show up in a sync, so look for the newly relevant ones in a full sync
+            self.log.info("Watched bridges changed, doing a full sync")
+            self.full_sync_requested = True
+        # room_id -> bridge states for rooms configured explicitly
+        self.explicit_room_states = dict()
+        for bridge_state in self.bridge_states.values():
+            for room_id in bridge_state.explicit_rooms:
+                self.explicit_room_states.setdefault(room_id, []).append(bridge_state)
+        self.sync_timeline_limit = config.get("sync_timeline_limit", SYNC_TIMELINE_LIMIT)
+        self.backfill_concurrency = config.get("backfill_concurrency", BACKFILL_CONCURRENCY)
+        self.backfill_page_size = config.get("backfill_page_size", BACKFILL_PAGE_SIZE)
+        # Re-issue the long poll right away instead of waiting between syncs
+        self.continuous_sync = config.get("continuous_sync", False)
+        # Parse syncs without nio's room bookkeeping, keeping only what is looked at
+        self.raw_sync = config.get("raw_sync", False)
+        self.message_filter = {
+            "types": MESSAGE_EVENT_TYPES + BRIDGE_EVENT_TYPES,
+            "lazy_load_members": True,
+        }
+        sync_filter = self.build_sync_filter()
+        if sync_filter != self.sync_filter:
+            self.sync_filter = sync_filter
+            self.sync_filter_id = None
+
+    def restore(self):
+        self.sync_next_batch_token = self.state_store.load("sync_token", self.mx_id)
+        self.room_bridge_ids = self.state_store.load_all("room_bridges", self.mx_id)
+        if self.sync_next_batch_token != None:
+            self.log.info(f"Resuming from stored sync token, {len(self.room_bridge_ids)} known rooms")
+            if any(self.state_store.load("user_bridge_state", self.mx_id, bridge_id) == None for bridge_id in self.bridge_states):
+                # Newly watched bridges did not see the rooms synced before
+                self.log.info("Watched bridges changed, doing a full sync")
+                self.full_sync_requested = True
+
+    def checkpoint(self):
+        if self.state_store == None:
+            return
+        for bridge_id in self.bridge_states:
+            self.state_store.save("user_bridge_state", self.mx_id, bridge_id, self.bridge_states[bridge_id].dump())
+        self.state_store.save("sync_token", self.mx_id, "", self.sync_next_batch_token)
+
+    def set_room_bridge_ids(self, room_id, bridge_ids):
+        self.room_bridge_ids[room_id] = bridge_ids
+        if self.state_store != None:
+            self.state_store.save("room_bridges", self.mx_id, room_id, bridge_ids)
+
+    def drop_room_bridge_ids(self, room_id):
+        self.room_bridge_ids.pop(room_id, None)
+        if self.state_store != None:
+            self.state_store.delete("room_bridges", self.mx_id, room_id)
 
-    def update_loop(self):
+    async def shutdown(self):
+        # Stop right away, also in the middle of a long poll
+        self.alive = False
+        self.task.cancel()
+        await self._close_client()
+
+    async def update_loop(self):
         try:
-            result = self.with_client(self.check_rooms)
+            if self.sync_next_batch_token == None or self.full_sync_requested:
+                # Full syncs are heavy on both sides, only a few at a time
+                async with self.userWatcher.initial_syncs:
+                    result = await self.async_with_client(self.check_rooms)
+            else:
+                result = await self.async_with_client(self.check_rooms)
             #return result if result != None else 120 # TODO? config: timeout in case of error
+            if self.continuous_sync and result != None:
+                return 0
+        except asyncio.CancelledError:
+            raise
         except:
             self.log.exception("Error in update loop")
             self.update_callbacks(None, False, True, "Internal error")
             #return 120 # TODO? config: timeout in case of error
-        return SYNC_DELAY_SECONDS
+        finally:
+            self.checked = True
+        # Back off while the homeserver is down
+        return max(SYNC_DELAY_SECONDS, self.breaker.retry_in())
+
+    def build_sync_filter(self):
+        # Only download what we look at: bridged messages, bridge state and unread counts
+        return {
+            "presence": {"not_types": ["*"]},
+            "account_data": {"not_types": ["*"]},
+            "room": {
+                "account_data": {"not_types": ["*"]},
+                "ephemeral": {"not_types": ["*"]},
+                "state": {"types": BRIDGE_EVENT_TYPES, "lazy_load_members": True},
+                "timeline": dict(self.message_filter, limit=self.sync_timeline_limit),
+            },
+        }
+
+    async def get_sync_filter(self, client):
+        if self.sync_filter_id == None:
+            response = await client.upload_filter(**self.sync_filter)
+            if not isinstance(response, UploadFilterResponse):
+                self.log.warning(f"Failed to upload sync filter, sending it inline: {response}")
+                return self.sync_filter
+            self.log.debug(f"Uploaded sync filter {response.filter_id}")
+            self.sync_filter_id = response.filter_id
+        return self.sync_filter_id
+
+    def sync_timeout(self):
+        # Return from the long poll in time for the next bridge state deadline
+        now = datetime.now()
+        timeout = SYNC_TIMEOUT_MILLIS
+        for bridge_state in self.bridge_states.values():
+            next_evaluation = bridge_state.next_evaluation(now)
+            if next_evaluation != None:
+                timeout = min(timeout, int((next_evaluation - now).total_seconds()*1000))
+        return max(0, timeout)
 
     async def check_rooms(self, client):
         # TODO? based on alert_after_inactivity, alert_period, and last activity (or fallback config?)
         ttl_to_next_timeout = SYNC_DELAY_SECONDS
+        if self.full_sync_requested:
+            self.full_sync_requested = False
+            self.sync_next_batch_token = None
         if self.sync_next_batch_token != None:
             self.log.debug("Incremental sync")
             client.next_batch = self.sync_next_batch_token
         else:
             self.log.debug("Initial sync")
+            # The client remembers where it left off otherwise
+            client.next_batch = None
         #rooms = client.rooms.values()
-        sync_response = await client.sync(SYNC_TIMEOUT_MILLIS)
+        sync_filter = await self.get_sync_filter(client)
+        with metrics.SYNC_DURATION.time(user = self.mx_id):
+            if self.raw_sync:
+                sync_response = await raw_sync(client, self.sync_next_batch_token, self.sync_timeout(), sync_filter,
+                        lambda room_id: self.needs_timeline(room_id, initial = self.sync_next_batch_token == None))
+            else:
+                sync_response = await client.sync(self.sync_timeout(), sync_filter = sync_filter)
         if isinstance(sync_response, SyncError):
             self.update_callbacks(None, False, True, info = f"Sync failed: {sync_response.message}")
+            if sync_response.transport_response != None and sync_response.transport_response.status >= 500:
+                raise HomeserverUnavailable(f"Sync failed: {sync_response.message}")
             return None # error case
-        elif not isinstance(sync_response, SyncResponse):
+        elif not isinstance(sync_response, (SyncResponse, RawSyncResponse)):
             self.update_callbacks(None, False, True, info = f"Sync failed: {sync_response}")
             return None # error case
         joins = sync_response.rooms.join
+        self.update_room_bridge_ids(sync_response, initial = self.sync_next_batch_token == None)
         self.log.debug(f"Handle {len(joins)} rooms")
-        for room_id in joins:
-            # Wants mark as read: room is in list, and has appropriate notification counts
-            # Needs mark as read: wants mark as read, but was not able to update read marker yet due to missing timeline events
-            wants_mark_as_read = False
-            needs_mark_as_read = False
-            # Check if room should be marked as unread
-            if room_id in self.auto_mark_read_rooms:
-                wants_mark_as_read = True
-            elif room_id in self.auto_mark_read_rooms_without_notification:
-                notifs = joins[room_id].unread_notifications
-                if notifs.notification_count == 0 and notifs.highlight_count == 0:
-                    wants_mark_as_read = True
-            # Mark room as unread if possible
-            if wants_mark_as_read:
-                if len(joins[room_id].timeline.events) == 0:
-                    needs_mark_as_read = True
-                else:
-                    try:
-                        latest_event = joins[room_id].timeline.events[-1].event_id
-                        self.log.debug(f"Update read marker for {room_id} to {latest_event}")
-                        await client.room_read_markers(room_id, latest_event, latest_event)
-                    except:
-                        self.log.exception("Failed to update read marker for {room_id}")
-            relevant_bridge_states = []
-            # Check explicit rooms (overwrite bridges):
-            for bridge_state in self.bridge_states.values():
-                if room_id in bridge_state.explicit_rooms:
-                    relevant_bridge_states.append(bridge_state)
-
-            if len(relevant_bridge_states) == 0:
-                bridges = await get_bridges(client, room_id)
-                bridge_ids = []
-                for bridge in bridges:
-                    try:
-                        bridge_id = bridge["protocol"]["id"]
-                        if bridge_id not in bridge_ids:
-                            bridge_ids.append(bridge_id)
-                    except:
-                        pass
-                if len(bridge_ids) != 1:
-                    if len(bridge_ids) > 0:
-                        self.log.debug(f"Skip {room_id}: no unique bridge: {bridge_ids}")
-                    continue
-                bridge = bridge_ids[0]
-                if bridge not in self.watched_bridge_ids:
-                    # Not a watched bridge
-                    continue
-                bridge_state = self.bridge_states[bridge]
-                if bridge_state not in relevant_bridge_states:
-                    relevant_bridge_states.append(bridge_state)
-
-            for bridge_state in relevant_bridge_states:
-                found_event = self.handle_events(bridge_state, reversed(joins[room_id].timeline.events))
-
-                # If not found: use messages API https://spec.matrix.org/v1.1/client-server-api/#get_matrixclientv3roomsroomidmessages
-                room_token = joins[room_id].timeline.prev_batch
-                while not found_event:
-                    # TODO filter using message_filter?
-                    self.log.debug(f"Backfill {room_id} ({bridge_state.bridge_id}) - {room_token}")
-                    room_response = await client.room_messages(room_id, start = room_token, direction = MessageDirection.back)
-                    if isinstance(room_response, RoomMessagesResponse):
-                        if needs_mark_as_read:
-                            needs_mark_as_read = False
-                            try:
-                                latest_event = room_response.chunk[0].event_id
-                                self.log.debug(f"Update read marker for {room_id} to {latest_event}")
-                                await client.room_read_markers(room_id, latest_event, latest_event)
-                            except:
-                                self.log.exception("Failed to update read marker for {room_id}")
-                        # TODO does this make sense?
-                        if room_response.end == room_token:
-                            # Do not re-run
-                            found_event = True
-                        room_token = room_response.end
-                        if self.handle_events(bridge_state, room_response.chunk):
-                            found_event = True
-                    else:
-                        # abort
-                        found_event = True
-                self.log.debug(f"Done checking {room_id} ({bridge_state.bridge_id})")
+        semaphore = asyncio.Semaphore(self.backfill_concurrency)
+        async def check_room_bounded(room_id):
+            async with semaphore:
+                await self.check_room(client, room_id, joins[room_id])
+        results = await asyncio.gather(*[check_room_bounded(room_id) for room_id in joins], return_exceptions = True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
         self.log.debug(f"Done handling {len(joins)} rooms")
 
         now = datetime.now()
         for bridge_state in self.bridge_states.values():
-            # TODO calculate ttls in there?
-            await bridge_state.maybe_update_callback(now, self, client)
+            if self.full_sync_requested:
+                # Configuration changed during this sync, wait for the full sync
+                break
+            # Only when there is a new message or a deadline expired
+            if bridge_state.needs_evaluation(now):
+                await bridge_state.maybe_update_callback(now, self, client)
+        self.report_sync_memory(sync_response, len(joins))
         self.sync_next_batch_token = sync_response.next_batch
+        self.checkpoint()
         return ttl_to_next_timeout
 
+    def needs_timeline(self, room_id, initial):
+        # Whether check_room might look at the timeline of a room, bridge events aside
+        if initial or room_id in self.explicit_room_states or room_id not in self.room_bridge_ids:
+            return True
+        if room_id in self.auto_mark_read_rooms or room_id in self.auto_mark_read_rooms_without_notification:
+            return True
+        bridge_ids = self.room_bridge_ids[room_id]
+        return len(bridge_ids) == 1 and bridge_ids[0] in self.watched_bridge_ids
+
+    def report_sync_memory(self, sync_response, rooms):
+        if isinstance(sync_response, SyncResponse):
+            self.last_sync_bytes = getattr(sync_response.transport_response, "content_length", None)
+            self.last_sync_peak_rss = None
+        else:
+            self.last_sync_bytes = sync_response.size
+            self.last_sync_peak_rss = sync_response.peak_rss
+        size = f"{self.last_sync_bytes/1024:.0f} KiB" if self.last_sync_bytes != None else "unknown size"
+        peak = f", peak memory while parsing {self.last_sync_peak_rss/1024/1024:.1f} MiB" if self.last_sync_peak_rss != None else ""
+        self.log.debug(f"Sync of {rooms} rooms ({size}) done{peak}")
+
+    async def check_room(self, client, room_id, room):
+        start_time = time.monotonic()
+        # Wants mark as read: room is in list, and has appropriate notification counts
+        # Needs mark as read: wants mark as read, but was not able to update read marker yet due to missing timeline events
+        wants_mark_as_read = False
+        needs_mark_as_read = False
+        # Check if room should be marked as unread
+        if room_id in self.auto_mark_read_rooms:
+            wants_mark_as_read = True
+        elif room_id in self.auto_mark_read_rooms_without_notification:
+            notifs = room.unread_notifications
+            if notifs.notification_count == 0 and notifs.highlight_count == 0:
+                wants_mark_as_read = True
+        # Mark room as unread if possible
+        if wants_mark_as_read:
+            if len(room.timeline.events) == 0:
+                needs_mark_as_read = True
+            else:
+                try:
+                    latest_event = room.timeline.events[-1].event_id
+                    self.log.debug(f"Update read marker for {room_id} to {latest_event}")
+                    await client.room_read_markers(room_id, latest_event, latest_event)
+                except:
+                    self.log.exception(f"Failed to update read marker for {room_id}")
+        # Check explicit rooms (overwrite bridges):
+        relevant_bridge_states = list(self.explicit_room_states.get(room_id, []))
+
+        if len(relevant_bridge_states) == 0:
+            if room_id not in self.room_bridge_ids:
+                with metrics.GET_BRIDGES_DURATION.time(user = self.mx_id):
+                    bridges = await get_bridges(client, room_id)
+                self.set_room_bridge_ids(room_id, get_bridge_ids(bridges))
+            bridge_ids = self.room_bridge_ids[room_id]
+            if len(bridge_ids) != 1:
+                if len(bridge_ids) > 0:
+                    self.log.debug(f"Skip {room_id}: no unique bridge: {bridge_ids}")
+                return
+            bridge = bridge_ids[0]
+            if bridge not in self.watched_bridge_ids:
+                # Not a watched bridge
+                return
+            relevant_bridge_states.append(self.bridge_states[bridge])
+
+        # Bridge states that still need to look further back in this room
+        searching = [bridge_state for bridge_state in relevant_bridge_states
+                if not self.handle_events(bridge_state, reversed(room.timeline.events))]
+
+        # If not found: use messages API https://spec.matrix.org/v1.1/client-server-api/#get_matrixclientv3roomsroomidmessages
+        # One backfill serves all bridge states watching this room
+        room_token = room.timeline.prev_batch
+        pages = 0
+        while len(searching) > 0:
+            self.log.debug(f"Backfill {room_id} ({', '.join(bridge_state.bridge_id for bridge_state in searching)}) - {room_token}")
+            with metrics.BACKFILL_PAGE_DURATION.time(user = self.mx_id):
+                room_response = await client.room_messages(room_id, start = room_token, direction = MessageDirection.back, limit = self.backfill_page_size, message_filter = self.message_filter)
+            pages += 1
+            if not isinstance(room_response, RoomMessagesResponse):
+                # abort
+                break
+            if needs_mark_as_read:
+                needs_mark_as_read = False
+                try:
+                    latest_event = room_response.chunk[0].event_id
+                    self.log.debug(f"Update read marker for {room_id} to {latest_event}")
+                    await client.room_read_markers(room_id, latest_event, latest_event)
+                except:
+                    self.log.exception(f"Failed to update read marker for {room_id}")
+            # No more history to look at, do not re-run
+            exhausted = room_response.end == None or room_response.end == room_token
+            room_token = room_response.end
+            searching = [bridge_state for bridge_state in searching
+                    if not self.handle_events(bridge_state, room_response.chunk)]
+            if exhausted:
+                break
+        self.log.debug(f"Done checking {room_id} ({', '.join(bridge_state.bridge_id for bridge_state in relevant_bridge_states)}) in {time.monotonic() - start_time:.3f}s with {pages} backfill pages")
+
+    def update_room_bridge_ids(self, sync_response, initial):
+        for room_id in sync_response.rooms.leave:
+            self.drop_room_bridge_ids(room_id)
+        joins = sync_response.rooms.join
+        for room_id in joins:
+            events = joins[room_id].state + joins[room_id].timeline.events
+            if initial:
+                # Initial sync comes with the full room state, so there is no need to ask for it again
+                self.set_room_bridge_ids(room_id, get_bridge_ids(get_bridges_from_events(events)))
+            elif any(is_bridge_event(event) for event in events):
+                # Bridge state changed, only a part of the state might be in here, so re-fetch it when needed
+                self.log.debug(f"Bridge state changed in {room_id}")
+                self.drop_room_bridge_ids(room_id)
+
     def handle_events(self, bridge_state, events):
         found_event = False
         now = datetime.now()
@@ -284,28 +552,141 @@ class WatchedUser(BaseMatrixUser, Looper):
 
 
 class UserWatcher:
-    def __init__(self, config, callbacks):
+    def __init__(self, config, callbacks, state_store = None, sharding = None):
+        self.log = logging.getLogger("UserWatcher")
         self.users = []
         self.callbacks = callbacks
+        self.state_store = state_store
+        self.sharding = sharding
+        self.users_config = config["watched_users"]
+        # Accounts of users watched by another shard, used here for sending only
+        self.senders = dict()
+        self.initial_syncs = asyncio.Semaphore(config.get("initial_sync_concurrency", INITIAL_SYNC_CONCURRENCY))
 
-        m_config = config["watched_users"]
-        for user_id in m_config:
-            user = m_config[user_id]
-            self.users.append(WatchedUser(user_id, user, self))
+        self.rebalance()
+        if sharding != None:
+            sharding.on_change(self.rebalance)
+        metrics.register_collector(self.collect_metrics)
 
-    async def send_with_user(self, watched_user, watched_user_client, user_id, room_id, text):
+    def is_assigned(self, user_id):
+        return self.sharding == None or self.sharding.owns(watched_user_key(user_id))
+
+    def rebalance(self):
+        # Start the users this instance is responsible for, and stop those that moved to another shard
+        running = {user.user_id: user for user in self.users}
+        started = 0
+        stopped = 0
+        for user_id in self.users_config:
+            user = running.get(user_id)
+            if self.is_assigned(user_id):
+                if user == None:
+                    self.users.append(WatchedUser(user_id, self.users_config[user_id], self))
+                    started += 1
+            elif user != None:
+                self.users.remove(user)
+                background_task(user.shutdown(), self.log)
+                stopped += 1
+        if self.sharding != None:
+            self.log.info(f"Watching {len(self.users)} users, started {started}, stopped {stopped}")
+
+    def is_warm(self):
+        # Whether every user did its first round of checks
+        return all(user.checked for user in self.users)
+
+    def collect_metrics(self):
+        now = datetime.now().timestamp()
+        since_message = []
+        is_good = []
+        opened = []
+        reused = []
+        sync_bytes = []
+        sync_peak = []
+        for user in self.users:
+            for bridge_state in user.bridge_states.values():
+                labels = {"user": user.mx_id, "bridge": bridge_state.bridge_id}
+                if bridge_state.last_bridged_message_ts > 0:
+                    since_message.append((labels, now - bridge_state.last_bridged_message_ts/1000))
+                is_good.append((labels, 1 if bridge_state.last_update_was_good else 0))
+            opened.append(({"user": user.mx_id}, user.connections_opened))
+            reused.append(({"user": user.mx_id}, user.connections_reused))
+            if user.last_sync_bytes != None:
+                sync_bytes.append(({"user": user.mx_id}, user.last_sync_bytes))
+            if user.last_sync_peak_rss != None:
+                sync_peak.append(({"user": user.mx_id}, user.last_sync_peak_rss))
+        return [
+            ("bridge_observer_seconds_since_bridged_message", "Time since the last bridged message seen by a watched user", "gauge", since_message),
+            ("bridge_observer_user_bridge_good", "Whether the last update for a watched user's bridge was good", "gauge", is_good),
+            ("bridge_observer_client_connections_opened_total", "Homeserver connections opened by an account's client", "counter", opened),
+            ("bridge_observer_client_connections_reused_total", "Homeserver connections reused by an account's client", "counter", reused),
+            ("bridge_observer_sync_peak_rss_bytes", "Peak resident memory of the process while a watched user's last sync response was parsed (raw_sync)", "gauge", sync_peak),
+            ("bridge_observer_sync_response_bytes", "Size of a watched user's last sync response", "gauge", sync_bytes),
+            ("bridge_observer_homeserver_circuit_open", "Whether requests to a homeserver are paused after repeated failures", "gauge",
+                [({"homeserver": homeserver}, 0 if breaker.state() == "closed" else 1) for homeserver, breaker in homeserver_breakers.items()]),
+        ]
+
+    def status(self):
+        # Current state of every watched user's bridges, with epoch timestamps
+        now = datetime.now()
+        status = []
+        for user in self.users:
+            for bridge_state in user.bridge_states.values():
+                bad_since = None
+                if not bridge_state.last_update_was_good and bridge_state.last_bridged_message_ts > 0:
+                    bad_since = bridge_state.last_bridged_message_ts/1000 + bridge_state.alert_after_inactivity.total_seconds()
+                status.append({
+                    "user": user.mx_id,
+                    "bridge": bridge_state.bridge_id,
+                    "is_good": bridge_state.last_update_was_good,
+                    "last_bridged_message_ts": bridge_state.last_bridged_message_ts,
+                    "bad_since": bad_since,
+                    "last_alert": to_timestamp(bridge_state.last_alert_ts),
+                    "next_check": to_timestamp(bridge_state.next_evaluation(now)),
+                })
+        return status
+
+    def reload(self, config):
+        # Restart users whose account changed, apply everything else in place
+        users_config = config["watched_users"]
+        for user in list(self.users):
+            old_config = self.users_config[user.user_id]
+            new_config = users_config.get(user.user_id)
+            if new_config == old_config:
+                continue
+            if new_config == None or any(old_config.get(key) != new_config.get(key) for key in ACCOUNT_KEYS):
+                self.users.remove(user)
+                background_task(user.shutdown(), self.log)
+            else:
+                user.log.info("Applying changed configuration")
+                user.apply_config(new_config)
+                user.update_now(self)
+        for user_id in list(self.senders):
+            if users_config.get(user_id) != self.users_config.get(user_id):
+                background_task(self.senders.pop(user_id)._close_client(), self.log)
+        self.users_config = users_config
+        self.rebalance()
+        self.log.info(f"Reloaded, watching {len(self.users)} users")
+
+    def get_sender(self, user_id):
         for user in self.users:
             if user.user_id == user_id:
-                async def fun(client):
-                    content = {
-                        "msgtype": "m.text",
-                        "body": text
-                    }
-                    await client.room_send(room_id, "m.room.message", content, ignore_unverified_devices=True)
-                if watched_user == user:
-                    # Use client directly, or it would block, since we already have a client
-                    await fun(watched_user_client)
-                else:
-                    user.with_client(fun)
-                return
+                return user
+        if user_id in self.users_config:
+            # Watched by another shard, only borrow the account
+            if user_id not in self.senders:
+                self.senders[user_id] = BaseMatrixUser(f"Sender_{user_id}", self.users_config[user_id])
+            return self.senders[user_id]
         raise Exception(f"User {user_id} not found in watched users")
+
+    async def send_with_user(self, watched_user, watched_user_client, user_id, room_id, text):
+        user = self.get_sender(user_id)
+        async def fun(client):
+            content = {
+                "msgtype": "m.text",
+                "body": text
+            }
+            await client.room_send(room_id, "m.room.message", content, ignore_unverified_devices=True)
+        if watched_user == user:
+            # Use client directly, we already have it at hand
+            await fun(watched_user_client)
+        else:
+            await user.async_with_client(fun)
@@ -1,7 +1,10 @@
+import asyncio
+import heapq
 import inspect
 import logging
 import os
-from threading import Event, Thread
+import random
+import time
 
 
 # Directory containing this file
@@ -10,48 +13,292 @@ this_dir = os.path.realpath(os.path.abspath(os.path.split(inspect.getfile( inspe
 def relative_path(path):
     return "{0}/{1}".format(this_dir, path)
 
-# Base class for looper thread classes
+# Keep references to fire-and-forget tasks, so they don't get garbage collected while running
+background_tasks = set()
+
+def background_task(coro, log):
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    def done(task):
+        background_tasks.discard(task)
+        if not task.cancelled() and task.exception() != None:
+            log.error("Background task failed", exc_info=task.exception())
+    task.add_done_callback(done)
+    return task
+
+# Defaults for circuit breakers
+BREAKER_FAILURES = 3
+BREAKER_BASE_SECONDS = 5
+BREAKER_MAX_SECONDS = 900
+
+class CircuitOpenError(Exception):
+    pass
+
+# Stops requests to a service that keeps failing: after `failures` failures in a row the circuit opens,
+# and requests fail right away until a backoff passed, which doubles (with jitter) each time the circuit opens again.
+# After the backoff a single probe request is let through (half-open), and its outcome closes or reopens the circuit.
+class CircuitBreaker:
+    def __init__(self, name, failures = BREAKER_FAILURES, base_delay = BREAKER_BASE_SECONDS, max_delay = BREAKER_MAX_SECONDS):
+        self.log = logging.getLogger(f"CircuitBreaker_{name}")
+        self.name = name
+        self.max_failures = failures
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        # Times the circuit opened in a row, without a successful probe
+        self.openings = 0
+        self.open_until = None
+        self.probing = False
+        self.short_circuited = 0
+    def state(self):
+        if self.open_until == None:
+            return "closed"
+        return "half_open" if self.probing or time.monotonic() >= self.open_until else "open"
+    def retry_in(self):
+        # Seconds until requests are let through again
+        if self.open_until == None:
+            return 0
+        return max(0, self.open_until - time.monotonic())
+    def allow(self):
+        if self.open_until == None:
+            return True
+        if not self.probing and time.monotonic() >= self.open_until:
+            self.probing = True
+            self.log.info(f"Probing {self.name}")
+            return True
+        self.short_circuited += 1
+        return False
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} unavailable, retrying in {self.retry_in():.0f}s")
+    def success(self):
+        # Returns whether this closed the circuit
+        self.failures = 0
+        if self.open_until == None:
+            return False
+        self.log.info(f"{self.name} is back, closing circuit")
+        self.openings = 0
+        self.open_until = None
+        self.probing = False
+        return True
+    def abandon(self):
+        # For a request that ended without an outcome (cancelled), so another probe may go ahead
+        self.probing = False
+    def failure(self):
+        self.failures += 1
+        if self.probing:
+            self.log.warning(f"Probing {self.name} failed")
+        elif self.open_until != None or self.failures < self.max_failures:
+            # Already open (a request started before), or not enough failures yet
+            return
+        delay = min(self.max_delay, self.base_delay * 2**self.openings) * random.uniform(0.5, 1)
+        self.openings += 1
+        self.open_until = time.monotonic() + delay
+        self.probing = False
+        self.log.warning(f"{self.name} failed {self.failures} times in a row, pausing requests for {delay:.0f}s")
+
+# Durations of consecutive phases, e.g. of startup
+class PhaseTimer:
+    def __init__(self, started = None):
+        self.started = started if started != None else time.monotonic()
+        self.last = self.started
+        # (phase name, seconds)
+        self.phases = []
+    def phase(self, name):
+        now = time.monotonic()
+        self.phases.append((name, now - self.last))
+        self.last = now
+    def total(self):
+        return self.last - self.started
+    def report(self):
+        return ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases)
+    def collect_metrics(self):
+        return [
+            ("bridge_observer_startup_phase_seconds", "Duration of each startup phase", "gauge", [({"phase": name}, seconds) for name, seconds in self.phases]),
+        ]
+
+# Highest peak before the last reset_peak_rss()
+peak_rss_before_reset = 0
+
+def reset_peak_rss():
+    # Resets the peak resident set size of the process, returns False where that is not supported (only Linux does)
+    global peak_rss_before_reset
+    peak = peak_rss()
+    try:
+        with open("/proc/self/clear_refs", "w") as fout:
+            fout.write("5")
+    except OSError:
+        return False
+    peak_rss_before_reset = max(peak_rss_before_reset, peak)
+    return True
+
+def process_peak_rss():
+    # Peak resident set size of the process since it started, in bytes
+    return max(peak_rss_before_reset, peak_rss())
+
+def peak_rss():
+    # Peak resident set size of the process in bytes, since the last reset_peak_rss()
+    try:
+        with open("/proc/self/status") as fin:
+            for line in fin:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    # Peak since start, in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+async def wait_until(condition, timeout, interval = 0.2):
+    # Returns whether the condition was met within the timeout
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+# Base class for looper task classes, all running on the shared event loop
 class Looper:
     def __init__(self, logname):
-        self.event = Event()
+        self.event = asyncio.Event()
         self.alive = True
-        self.thread = None
+        self.task = None
         self.log = logging.getLogger(logname)
     def prepare_loop(self):
         pass
-    def prepare_thread(self):
-        pass
     def on_loop(self):
         pass
-    def update_loop_wrapper(self, func):
-        self.prepare_thread()
+    async def update_loop_wrapper(self, func):
         while self.alive:
             self.prepare_loop()
             if not self.alive:
                 break
             try:
                 self.event.clear()
-                time = func()
+                time = await func()
                 self.on_loop()
-                self.event.wait(time)
+                await self.wait(time)
+            except asyncio.CancelledError:
+                break
             except:
                 self.log.exception("Broken loop")
-                self.event.wait(1)
+                await self.wait(1)
         self.log.info("Stopped")
+    async def wait(self, time):
+        try:
+            await asyncio.wait_for(self.event.wait(), time)
+        except asyncio.TimeoutError:
+            pass
     def start_loop(self, func):
-        self.thread = Thread(target=self.update_loop_wrapper, args=(func,))
-        self.thread.start()
+        self.task = asyncio.get_running_loop().create_task(self.update_loop_wrapper(func))
     def update_now(self, updated_by):
         self.event.set()
-    def stop(self):
+    async def stop(self):
         self.log.info("Initiating stop")
         self.alive = False
         self.update_now(self)
         try:
-            self.thread.join()
+            await self.task
         except:
             self.log.exception("stop")
 
+# Runs many jobs on their own deadlines from a single heap, instead of one looper per job.
+# Jobs implement `async def update_loop()`, returning the seconds until they want to run again.
+class DeadlineScheduler:
+    def __init__(self, logname, jitter = 0):
+        self.log = logging.getLogger(logname)
+        # Run jobs up to this many seconds early, to spread out jobs that would otherwise stay in phase
+        self.jitter = jitter
+        # (deadline, seq, job), may contain outdated entries which are skipped when popped
+        self.heap = []
+        self.deadlines = dict()
+        self.seq = 0
+        self.jobs = set()
+        self.running = set()
+        self.rerun = set()
+        self.wakeup = asyncio.Event()
+        self.task = None
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+    def add(self, job):
+        self.jobs.add(job)
+        # Spread initial runs over the jitter window
+        self._schedule(job, random.uniform(0, self.jitter))
+    def remove(self, job):
+        self.jobs.discard(job)
+        self.deadlines.pop(job, None)
+        self.rerun.discard(job)
+    def update_now(self, job):
+        if job in self.running:
+            self.rerun.add(job)
+        elif job in self.jobs:
+            self._schedule(job, 0)
+    def reschedule(self, job, delay):
+        # Move the next run of an idle job, returns False if it is running or has a run pending
+        if job in self.running or job not in self.jobs or self.deadlines.get(job, 0) <= time.monotonic():
+            return False
+        self._schedule(job, max(0, delay - random.uniform(0, self.jitter)))
+        return True
+    def _schedule(self, job, delay):
+        deadline = time.monotonic() + delay
+        self.deadlines[job] = deadline
+        self.seq += 1
+        heapq.heappush(self.heap, (deadline, self.seq, job))
+        if len(self.heap) > 2*len(self.deadlines) + 64:
+            # Mostly outdated entries, e.g. from frequently postponed jobs
+            self.heap = [entry for entry in self.heap if self.deadlines.get(entry[2]) == entry[0]]
+            heapq.heapify(self.heap)
+        if self.heap[0][2] is job:
+            self.wakeup.set()
+    def upcoming(self):
+        now = time.monotonic()
+        return sorted(((deadline - now, job) for job, deadline in self.deadlines.items()), key=lambda entry: entry[0])
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            while len(self.heap) > 0:
+                deadline, _, job = self.heap[0]
+                if self.deadlines.get(job) != deadline:
+                    # Rescheduled or removed meanwhile
+                    heapq.heappop(self.heap)
+                elif deadline <= now:
+                    heapq.heappop(self.heap)
+                    del self.deadlines[job]
+                    self.running.add(job)
+                    background_task(self._run_job(job), self.log)
+                else:
+                    break
+            timeout = self.heap[0][0] - now if len(self.heap) > 0 else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    async def _run_job(self, job):
+        try:
+            delay = await job.update_loop()
+        except asyncio.CancelledError:
+            raise
+        except:
+            self.log.exception("Broken job")
+            delay = 1
+        finally:
+            self.running.discard(job)
+        if job not in self.jobs:
+            return
+        if job in self.rerun:
+            self.rerun.discard(job)
+            delay = 0
+        elif delay > 0:
+            delay = max(0, delay - random.uniform(0, self.jitter))
+        self._schedule(job, delay)
+    def stop(self):
+        if self.task != None:
+            self.task.cancel()
+
+BRIDGE_EVENT_TYPES = ["m.bridge", "uk.half-shot.bridge"]
+
 async def get_bridges(client, room):
     if isinstance(room, str):
         room_id = room
@@ -61,7 +308,7 @@ async def get_bridges(client, room):
     bridges = []
     for event in result.events:
         try:
-            if event['type'] == "m.bridge" or event['type'] == "uk.half-shot.bridge":
+            if event['type'] in BRIDGE_EVENT_TYPES:
                 content = event["content"]
                 #bridge_id = content["protocol"]["id"]
                 #bridgebot
@@ -69,3 +316,25 @@ async def get_bridges(client, room):
         except KeyError as e:
             continue
     return bridges
+
+def get_bridge_ids(bridges):
+    bridge_ids = []
+    for bridge in bridges:
+        try:
+            bridge_id = bridge["protocol"]["id"]
+            if bridge_id not in bridge_ids:
+                bridge_ids.append(bridge_id)
+        except:
+            pass
+    return bridge_ids
+
+def is_bridge_event(event):
+    return event.source.get("type") in BRIDGE_EVENT_TYPES and "state_key" in event.source
+
+def get_bridges_from_events(events):
+    # Latest bridge state content per state key, from state events as found in a sync response
+    bridges = dict()
+    for event in events:
+        if is_bridge_event(event):
+            bridges[(event.source["type"], event.source["state_key"])] = event.source.get("content", {})
+    return list(bridges.values())